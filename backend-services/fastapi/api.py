@@ -1,9 +1,19 @@
-from fastapi import FastAPI, HTTPException
+import os
+import time
+import signal
+import asyncio
+import secrets
+from typing import Optional
+
+from fastapi import FastAPI, HTTPException, Header, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import PlainTextResponse
-from pydantic import BaseModel
+from fastapi.responses import PlainTextResponse, JSONResponse
+from pydantic import BaseModel, Field
 from contextlib import asynccontextmanager
-from prediction_model import ApiRequestHandler
+from handler_executor import HandlerExecutor, ExecutorBusy
+from metrics import service_metrics, current_request, RequestTimings
+from slow_request_profiler import SlowRequestProfiler
+import serving
 
 
 class PredictionRequest(BaseModel):
@@ -11,15 +21,59 @@ class PredictionRequest(BaseModel):
     player2: str
     court_surface: str
 
+class AnytimePredictionRequest(PredictionRequest):
+    # Both optional. Without either one the whole forest is evaluated, like /predict_winner.
+    budget_ms: Optional[float] = Field(default=None, gt=0)
+    min_margin: Optional[float] = Field(default=None, gt=0, le=1)
+
+class BatchPredictionRequest(BaseModel):
+    matchups: list[PredictionRequest]
+
 class StatsLookupRequest(BaseModel):
     player: str
 
 
+async def load_startup_handler():
+    # Runs off the event loop so /healthz keeps answering while the tables and model load.
+    try:
+        app.state.handler = await asyncio.get_running_loop().run_in_executor(None, serving.load_handler)
+    except Exception as e:
+        app.state.startup_error = str(e)
+        print(f"Startup failed: {e}")
+        return
+    serving.print_startup_report(app.state.handler)
+    serving.print_worker_memory_report()
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-        handler = ApiRequestHandler()
-        app.state.handler = handler
+        # With several workers the handler was loaded once before forking (see serving.py). Otherwise it is
+        # loaded in the background and the routes answer 503 until /readyz reports ready.
+        app.state.handler = serving.preloaded_handler
+        app.state.startup_error = None
+        app.state.startup_task = None
+        # Shared with the other workers when several are forked (see serving.py).
+        app.state.reload_status = serving.reload_status or serving.ReloadStatus()
+        app.state.reload_task = None
+        app.state.watch_task = None
+        # Handler calls are CPU bound, so they run on a bounded thread pool instead of the event loop.
+        app.state.executor = HandlerExecutor()
+        # Off unless PROFILE_SLOW_REQUESTS_MS is set.
+        app.state.profiler = SlowRequestProfiler.from_environment()
+        if app.state.profiler is not None:
+            app.state.profiler.start()
+        if app.state.handler is None:
+            app.state.startup_task = asyncio.create_task(load_startup_handler())
+        else:
+            serving.print_worker_memory_report()
+        # With forked workers the parent watches the tables, so it can reload all of them at once.
+        if serving.parent_pid is None and float(os.environ.get("RELOAD_WATCH_SECONDS", 0)) > 0:
+            app.state.watch_task = asyncio.create_task(watch_tables())
         yield
+        if app.state.watch_task is not None:
+            app.state.watch_task.cancel()
+        app.state.executor.shutdown()
+        if app.state.profiler is not None:
+            app.state.profiler.stop()
 
 app = FastAPI(lifespan=lifespan)
 
@@ -37,26 +91,203 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    # Latency and status per route, plus the handler stages of this request in a Server-Timing header.
+    timings = RequestTimings()
+    current_request.set(timings)
+    try:
+        response = await call_next(request)
+    except Exception:
+        observe_request(request, 500, timings)
+        raise
+    elapsed = observe_request(request, response.status_code, timings)
+    response.headers["Server-Timing"] = timings.server_timing(elapsed)
+    return response
+
+def observe_request(request: Request, status: int, timings: RequestTimings) -> float:
+    elapsed = time.perf_counter() - timings.start
+    # Labelled with the route template, not the raw path, so unknown URLs don't each get their own series.
+    route = request.scope.get("route")
+    route_path = route.path if route is not None else "unmatched"
+    service_metrics.observe_request(route_path, request.method, status, elapsed)
+
+    profiler = app.state.profiler
+    if profiler is not None and profiler.is_slow(elapsed):
+        # Written off the event loop. The response doesn't wait for it.
+        asyncio.get_running_loop().run_in_executor(None, profiler.dump, route_path, elapsed, timings.intervals)
+    return elapsed
+
+def busy_response(e: ExecutorBusy) -> HTTPException:
+    return HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+
+def current_handler():
+    handler = app.state.handler
+    if handler is None:
+        raise HTTPException(status_code=503, detail="The service is still starting up.", headers={"Retry-After": "1"})
+    return handler
+
+@app.get("/healthz")
+async def healthz():
+    # Liveness only: the process is up and the event loop is answering. Doesn't wait for the tables or model.
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz():
+    # Readiness: the tables, indexes and model are loaded. Also reports how long each startup phase took.
+    handler = app.state.handler
+    if handler is None or handler.model is None:
+        content = {"ready": False}
+        if app.state.startup_error:
+            content["error"] = app.state.startup_error
+        return JSONResponse(status_code=503, content=content)
+    return {"ready": True, "startup_seconds": handler.startup_timings}
+
 @app.post("/predict_winner")
 async def winner_prediction(request_data: PredictionRequest):
     try:
-        predicted_winner_name = app.state.handler.prediction_request(request_data.player1, request_data.player2, request_data.court_surface)
+        predicted_winner_name = await app.state.executor.run(
+            current_handler().winner_prediction, request_data.player1, request_data.player2, request_data.court_surface)
         return PlainTextResponse(predicted_winner_name)
 
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
+    except ExecutorBusy as e:
+        raise busy_response(e)
+
+@app.post("/predict_winner/batch")
+async def batch_winner_prediction(request_data: BatchPredictionRequest):
+    # Unknown players are reported per matchup in the response instead of failing the request.
+    matchups = [(matchup.player1, matchup.player2, matchup.court_surface) for matchup in request_data.matchups]
+    try:
+        predictions = await app.state.executor.run(current_handler().batch_winner_prediction, matchups)
+        return {"predictions": predictions}
+
+    except ExecutorBusy as e:
+        raise busy_response(e)
+
+@app.post("/predict_winner/anytime")
+async def anytime_winner_prediction(request_data: AnytimePredictionRequest):
+    # The budget counts from the request's arrival, so time spent queued for a handler thread leaves fewer trees.
+    budget_ms = request_data.budget_ms
+    if budget_ms is None and os.environ.get("ANYTIME_BUDGET_MS"):
+        budget_ms = float(os.environ["ANYTIME_BUDGET_MS"])
+    deadline = current_request.get().start + budget_ms / 1000 if budget_ms is not None else None
+    try:
+        return await app.state.executor.run(
+            current_handler().anytime_winner_prediction, request_data.player1, request_data.player2,
+            request_data.court_surface, deadline, request_data.min_margin)
+
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except ExecutorBusy as e:
+        raise busy_response(e)
 
 @app.post("/lookup_player_stats")
 async def player_stats_lookup(request_data: StatsLookupRequest):
     try:
-        player_stats = app.state.handler.player_stats_lookup_request(request_data.player)
+        player_stats = await app.state.executor.run(current_handler().stats_lookup, request_data.player)
         return PlainTextResponse(player_stats)
     
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
+    except ExecutorBusy as e:
+        raise busy_response(e)
+
+@app.get("/players/search")
+async def player_search(q: str = Query(min_length=1, max_length=100), limit: int = Query(default=10, ge=1, le=50)):
+    # Autocomplete over the known player names. Runs on the event loop: it's an index lookup, not model work.
+    return {"query": q, "players": current_handler().player_search(q, limit)}
+
+@app.get("/executor_stats")
+async def executor_stats():
+    # Concurrency limit, requests in flight and how many are waiting for a thread.
+    return app.state.executor.stats()
+
+async def reload_handler():
+    # Single process: builds a complete new handler (tables, indexes, model) off the event loop, then swaps it in
+    # with a single assignment. Requests already running keep the bound methods of the old handler and finish on it.
+    app.state.reload_status.start()
+    try:
+        new_handler = await asyncio.get_running_loop().run_in_executor(None, serving.load_handler, app.state.handler)
+    except Exception as e:
+        app.state.reload_status.finish(error=str(e))
+        return
+    app.state.handler = new_handler
+    app.state.reload_status.finish()
+
+async def watch_tables():
+    # RELOAD_WATCH_SECONDS: reload when the table files change, e.g. after the scraper has rebuilt them.
+    while app.state.handler is None:
+        if app.state.startup_error:
+            # Nothing to reload into. /readyz reports the error.
+            print("Not watching the tables: startup failed.")
+            return
+        await asyncio.sleep(1)
+    watcher, interval = serving.TablesWatcher.from_environment(app.state.handler.tables_dir)
+    while True:
+        await asyncio.sleep(interval)
+        if watcher.changed() and (app.state.reload_task is None or app.state.reload_task.done()):
+            print("Table files changed. Reloading.")
+            app.state.reload_task = asyncio.create_task(reload_handler())
+            await app.state.reload_task
+            watcher.reset()
+
+def check_admin_token(x_admin_token: Optional[str]):
+    # The node middleware forwards every POST, so admin routes stay disabled unless a token is configured.
+    admin_token = os.environ.get("ADMIN_TOKEN")
+    if not admin_token:
+        raise HTTPException(status_code=403, detail="Admin routes are disabled. Set ADMIN_TOKEN to enable them.")
+    if not x_admin_token or not secrets.compare_digest(x_admin_token, admin_token):
+        raise HTTPException(status_code=401, detail="Invalid admin token.")
+
+@app.post("/admin/reload", status_code=202)
+async def admin_reload(x_admin_token: Optional[str] = Header(default=None)):
+    # Reloads the tables and model. With forked workers the request is passed on to the parent, which reloads once
+    # and replaces every worker (see serving.py), so this worker is replaced too.
+    check_admin_token(x_admin_token)
+    reload_running = app.state.reload_task is not None and not app.state.reload_task.done()
+    if reload_running or app.state.reload_status.get()["state"] == "running":
+        raise HTTPException(status_code=409, detail="A reload is already running.")
+    if serving.parent_pid is not None:
+        # Marked here already, so a second request to any worker gets the 409 before the parent picks this up.
+        app.state.reload_status.start()
+        os.kill(serving.parent_pid, signal.SIGHUP)
+    else:
+        app.state.reload_task = asyncio.create_task(reload_handler())
+    return {"state": "running"}
+
+@app.get("/admin/reload")
+async def admin_reload_status(x_admin_token: Optional[str] = Header(default=None)):
+    check_admin_token(x_admin_token)
+    return app.state.reload_status.get()
+
+@app.get("/metrics")
+async def metrics():
+    # Prometheus text format. Per worker: with several workers, each scrape reaches one of them.
+    gauges = {"atp_ready": {"": int(app.state.handler is not None and app.state.handler.model is not None)}}
+    counters = {}
+    for key, value in app.state.executor.stats().items():
+        if key == "rejected":
+            counters["atp_executor_rejected_total"] = {"": value}
+        else:
+            gauges[f"atp_executor_{key}"] = {"": value}
+    # The cache hit, miss and eviction counters are kept in service_metrics, so they survive a reload.
+    if app.state.handler is not None:
+        for cache in (app.state.handler.prediction_cache, app.state.handler.stats_cache):
+            cache_stats = cache.stats()
+            for key in ("size", "max_size"):
+                gauges.setdefault(f"atp_response_cache_{key}", {})[cache.labels] = cache_stats[key]
+    return PlainTextResponse(service_metrics.render(gauges, counters), media_type="text/plain; version=0.0.4")
+
+@app.get("/cache_stats")
+async def cache_stats():
+    handler = current_handler()
+    return {"predictions": handler.prediction_cache.stats(),
+            "player_stats": handler.stats_cache.stats()}
 
 
 if __name__ == "__main__":
-    import uvicorn
     #port = int(os.environ.get("PORT", 8000))
-    uvicorn.run("API:app", host="0.0.0.0", port=8080)
\ No newline at end of file
+    workers = int(os.environ.get("WEB_CONCURRENCY", 1))
+    serving.serve("api:app", host="0.0.0.0", port=8080, workers=workers)
\ No newline at end of file
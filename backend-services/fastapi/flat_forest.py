@@ -0,0 +1,178 @@
+import time
+
+import numpy as np
+
+'''
+Inference engine for a fitted RandomForestClassifier, with every tree exported into shared flat NumPy arrays.
+
+sklearn scores a forest one tree object at a time, with input validation and joblib dispatch on every call. For the
+one or two rows of an API request that overhead is most of the latency. Here all trees are walked together: one
+vectorized step moves every (tree, row) pair one level down, and pairs that reached a leaf drop out.
+
+Predictions are identical to sklearn's:
+- Inputs are cast to float32 and compared with '<=' against the split thresholds, like sklearn's tree traversal.
+  Thresholds are stored as the largest float32 not above the original float64 threshold, which gives the same result
+  for every float32 input at half the size.
+- NaN goes to the child recorded in the tree's missing_go_to_left. For trees fitted without missing values that is
+  the child with the most training samples. The TotalWins features are always missing at prediction time.
+- Leaf values are the tree's class fractions (sklearn >= 1.4). They are summed over the trees in order and divided by
+  the number of trees, the same floating point operations as RandomForestClassifier.predict_proba.
+
+Each step is a handful of NumPy calls, so the cost is per call for small inputs and per element for large ones. Past a
+few hundred rows sklearn's compiled traversal is faster again. HybridForest hands those batches to sklearn, at the cost
+of keeping the sklearn trees in memory as well. The API uses FlatForest alone unless INFERENCE_ENGINE=hybrid.
+
+predict_proba_anytime evaluates the trees in chunks and can stop before the end of the forest: once no remaining tree
+can change the predicted class, once the vote margin is wide enough, or when a deadline has passed.
+
+The sklearn model can be dropped once exported. Exposes the parts of its interface the API uses: predict,
+predict_proba and classes_.
+'''
+
+
+class FlatForest:
+    def __init__(self, model):
+        trees = [estimator.tree_ for estimator in model.estimators_]
+        self.classes_ = model.classes_
+        self.n_features_in_ = model.n_features_in_
+        self.n_trees = len(trees)
+        self.max_depth = max(tree.max_depth for tree in trees)
+
+        node_counts = np.array([tree.node_count for tree in trees])
+        offsets = np.concatenate([[0], np.cumsum(node_counts)[:-1]])
+        node_offsets = np.repeat(offsets, node_counts)
+        left = np.concatenate([tree.children_left for tree in trees])
+        right = np.concatenate([tree.children_right for tree in trees])
+        is_leaf = left == -1
+
+        # Nodes are renumbered with the split nodes of all trees first and the leaves after them. Reaching a leaf is
+        # then 'node >= n_splits', and the split arrays and the leaf values only need an entry for their own nodes.
+        self.n_splits = int((~is_leaf).sum())
+        new_ids = np.empty(len(left), dtype=np.int64)
+        new_ids[~is_leaf] = np.arange(self.n_splits)
+        new_ids[is_leaf] = self.n_splits + np.arange(is_leaf.sum())
+        self.roots = new_ids[offsets].astype(np.int32)
+
+        splits = ~is_leaf
+        # children[2 * node] is the left child and children[2 * node + 1] the right one.
+        self.children = np.column_stack([new_ids[left[splits] + node_offsets[splits]],
+                                         new_ids[right[splits] + node_offsets[splits]]]).ravel().astype(np.int32)
+        feature = np.concatenate([tree.feature for tree in trees])[splits]
+        self.feature = feature.astype(np.min_scalar_type(self.n_features_in_))
+        threshold = np.concatenate([tree.threshold for tree in trees])[splits]
+        threshold32 = threshold.astype(np.float32)
+        rounded_up = threshold32.astype(np.float64) > threshold
+        threshold32[rounded_up] = np.nextafter(threshold32[rounded_up], np.float32(-np.inf))
+        self.threshold = threshold32
+        self.missing_go_to_left = np.concatenate([tree.missing_go_to_left for tree in trees])[splits].astype(bool)
+
+        # Single output forest: value has shape (nodes, 1, classes). Indexed by leaf id - n_splits.
+        values = np.concatenate([tree.value[:, 0, :len(self.classes_)] for tree in trees])
+        self.leaf_value = values[is_leaf]
+
+    @property
+    def nbytes(self) -> int:
+        return sum(array.nbytes for array in (self.roots, self.children, self.feature, self.threshold,
+                                              self.missing_go_to_left, self.leaf_value))
+
+    def apply(self, X: np.ndarray, roots: np.ndarray = None) -> np.ndarray:
+        # Leaf reached by every row in every tree, shape (trees, rows). 'roots' can select a subset of the trees.
+        roots = self.roots if roots is None else roots
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        n_rows = X.shape[0]
+        X_flat = X.ravel()
+        has_missing = np.isnan(X_flat).any()
+
+        leaves = np.empty(len(roots) * n_rows, dtype=np.int32)
+        # The (tree, row) pairs still on their way down: position in 'leaves', current node and the row's offset in X.
+        pending = np.arange(len(roots) * n_rows)
+        nodes = np.repeat(roots, n_rows)
+        row_offsets = np.tile(np.arange(n_rows) * X.shape[1], len(roots))
+        for _ in range(self.max_depth + 1):
+            # Pairs that reached a leaf are dropped, so each step only works on the paths that are still going.
+            at_leaf = nodes >= self.n_splits
+            if at_leaf.any():
+                leaves[pending[at_leaf]] = nodes[at_leaf]
+                going = ~at_leaf
+                pending, nodes, row_offsets = pending[going], nodes[going], row_offsets[going]
+                if not len(nodes):
+                    break
+            values = X_flat[row_offsets + self.feature[nodes]]
+            go_right = values > self.threshold[nodes]
+            if has_missing:
+                # NaN compares false either way. It goes where the tree sends missing values.
+                go_right |= np.isnan(values) & ~self.missing_go_to_left[nodes]
+            nodes = self.children[2 * nodes + go_right]
+
+        return leaves.reshape(len(roots), n_rows)
+
+    def predict_proba(self, X) -> np.ndarray:
+        # cumsum adds the trees one after another, in the same order as sklearn, so the sums match bit for bit.
+        tree_values = self.leaf_value[self.apply(X) - self.n_splits]
+        return np.cumsum(tree_values, axis=0)[-1] / self.n_trees
+
+    def predict_proba_anytime(self, X, chunk_size: int = 50, min_margin: float = None,
+                              deadline: float = None) -> tuple[np.ndarray, int, str]:
+        # Probabilities from the first trees_used trees, trees_used and why evaluation stopped:
+        # - 'complete': every tree was evaluated, same result as predict_proba.
+        # - 'decided': each tree moves the vote difference between two classes by at most 1, so once the leading
+        #   class is ahead by more than the trees left, the full forest predicts the same class for every row.
+        # - 'margin': the leading class is ahead by at least min_margin (difference of the class probabilities so far)
+        #   for every row. The full forest's class can still differ, rarely.
+        # - 'budget': time.perf_counter() passed 'deadline'. At least one chunk is always evaluated.
+        if chunk_size < 1:
+            # An empty chunk would never add trees, so the loop would not end.
+            raise ValueError(f"chunk_size must be at least 1, got {chunk_size}.")
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        vote_sums = np.zeros((X.shape[0], len(self.classes_)))
+        trees_used = 0
+        # Every chunk costs a full traversal loop, and for a row or two that fixed cost is most of it: half the forest
+        # takes about three quarters of the time of the whole. With only the 'decided' rule nothing can stop before
+        # half the trees have voted, so splitting there would cost more than it could save. The whole forest is then
+        # evaluated in one chunk, same as predict_proba.
+        chunk_size = self.n_trees if min_margin is None and deadline is None else chunk_size
+        while True:
+            roots = self.roots[trees_used:trees_used + chunk_size]
+            tree_values = self.leaf_value[self.apply(X, roots) - self.n_splits]
+            # Added after the running sums in tree order, so a complete run matches predict_proba bit for bit.
+            vote_sums = np.cumsum(np.concatenate([vote_sums[np.newaxis], tree_values]), axis=0)[-1]
+            trees_used += len(roots)
+            if trees_used == self.n_trees:
+                return vote_sums / self.n_trees, trees_used, 'complete'
+
+            top_two = np.sort(vote_sums, axis=1)[:, -2:]
+            lead = top_two[:, 1] - top_two[:, 0]
+            if (lead > self.n_trees - trees_used).all():
+                return vote_sums / trees_used, trees_used, 'decided'
+            if min_margin is not None and (lead / trees_used >= min_margin).all():
+                return vote_sums / trees_used, trees_used, 'margin'
+            if deadline is not None and time.perf_counter() >= deadline:
+                return vote_sums / trees_used, trees_used, 'budget'
+
+    def predict(self, X) -> np.ndarray:
+        return self.classes_.take(np.argmax(self.predict_proba(X), axis=1), axis=0)
+
+
+class HybridForest:
+    # Picks the engine by the number of rows: the flat arrays below 'max_flat_rows', where they are much faster,
+    # and sklearn's compiled traversal for larger batches, where the flat traversal's per-element cost is higher.
+    # Both give the same predictions. Keeps the sklearn model, so it uses more memory than FlatForest alone.
+    def __init__(self, model, max_flat_rows: int = 256):
+        self.model = model
+        self.flat_forest = FlatForest(model)
+        self.max_flat_rows = max_flat_rows
+        self.classes_ = model.classes_
+        self.n_trees = self.flat_forest.n_trees
+
+    def engine(self, X):
+        return self.flat_forest if len(X) <= self.max_flat_rows else self.model
+
+    def predict_proba(self, X) -> np.ndarray:
+        return self.engine(X).predict_proba(X)
+
+    def predict(self, X) -> np.ndarray:
+        return self.engine(X).predict(X)
+
+    def predict_proba_anytime(self, X, chunk_size: int = 50, min_margin: float = None,
+                              deadline: float = None) -> tuple[np.ndarray, int, str]:
+        return self.flat_forest.predict_proba_anytime(X, chunk_size, min_margin, deadline)
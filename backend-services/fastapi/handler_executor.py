@@ -0,0 +1,57 @@
+import os
+import asyncio
+import functools
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+'''
+Runs the blocking ApiRequestHandler calls (pandas lookups, sklearn inference) off the asyncio event loop.
+
+At most 'max_workers' calls run at once and at most 'max_queue' more wait for a thread. Anything beyond that is
+rejected straight away with ExecutorBusy (503 in the API), so an overload shows up as fast errors instead of
+requests piling up with unbounded latency.
+'''
+
+
+class ExecutorBusy(Exception):
+    pass
+
+
+class HandlerExecutor:
+    def __init__(self, max_workers: int = None, max_queue: int = None):
+        self.max_workers = max_workers or int(os.environ.get("HANDLER_THREADS", min(4, os.cpu_count() or 1)))
+        self.max_queue = max_queue if max_queue is not None else int(os.environ.get("HANDLER_QUEUE", 32))
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='handler')
+        # Only touched from the event loop thread, so no lock is needed.
+        self.in_flight = 0
+        self.rejected = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return max(0, self.in_flight - self.max_workers)
+
+    async def run(self, function, *args):
+        if self.in_flight >= self.max_workers + self.max_queue:
+            self.rejected += 1
+            raise ExecutorBusy("Server is busy. Please try again shortly.")
+
+        self.in_flight += 1
+        try:
+            loop = asyncio.get_running_loop()
+            # Runs in a copy of the caller's context, so per-request values (the stage timings) reach the thread.
+            context = contextvars.copy_context()
+            return await loop.run_in_executor(self.executor, functools.partial(context.run, function, *args))
+        finally:
+            self.in_flight -= 1
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'max_workers': self.max_workers,
+            'max_queue': self.max_queue,
+            'in_flight': self.in_flight,
+            'queue_depth': self.queue_depth,
+            'rejected': self.rejected,
+        }
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
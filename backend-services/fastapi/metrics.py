@@ -0,0 +1,129 @@
+import time
+import bisect
+import threading
+import contextvars
+from contextlib import contextmanager
+
+'''
+In-process metrics for the API: latency histograms per handler stage and per route, and request and error counts.
+Rendered in the Prometheus text format on /metrics, no client library needed.
+
+Stage timings are also collected per request, through a context variable, for the Server-Timing header and the slow
+request profiler. HandlerExecutor copies the context onto its threads, so stages timed there count for the request.
+'''
+
+# Seconds. From a cached lookup up to a request stuck behind a full queue.
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+
+class Histogram:
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Last one is +Inf.
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name: str, labels: str) -> list[str]:
+        # Prometheus buckets are cumulative.
+        lines = []
+        cumulative = 0
+        for bucket, count in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += count
+            le = '+Inf' if bucket == float('inf') else repr(bucket)
+            lines.append(f'{name}_bucket{{{labels},le="{le}"}} {cumulative}')
+        lines.append(f'{name}_sum{{{labels}}} {self.sum}')
+        lines.append(f'{name}_count{{{labels}}} {self.count}')
+        return lines
+
+
+class RequestTimings:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = {}  # stage -> seconds, summed when a stage runs more than once
+        self.intervals = []  # (thread id, start, end) per stage, used by the slow request profiler
+
+    def server_timing(self, total: float) -> str:
+        # Server-Timing header value, durations in milliseconds.
+        entries = [f'{stage};dur={seconds * 1000:.3f}' for stage, seconds in self.stages.items()]
+        entries.append(f'total;dur={total * 1000:.3f}')
+        return ', '.join(entries)
+
+
+current_request = contextvars.ContextVar('current_request', default=None)
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stage_latency = {}  # stage -> Histogram
+        self.request_latency = {}  # route -> Histogram
+        self.requests = {}  # (route, method, status) -> count
+        self.errors = {}  # (route, method, status) -> count
+        self.counters = {}  # name -> {labels: count}, for counts that don't fit the above
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            with self.lock:
+                self.stage_latency.setdefault(name, Histogram()).observe(end - start)
+            timings = current_request.get()
+            if timings is not None:
+                timings.stages[name] = timings.stages.get(name, 0.0) + end - start
+                timings.intervals.append((threading.get_ident(), start, end))
+
+    def observe_request(self, route: str, method: str, status: int, seconds: float):
+        key = (route, method, status)
+        with self.lock:
+            self.request_latency.setdefault(route, Histogram()).observe(seconds)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            if status >= 400:
+                self.errors[key] = self.errors.get(key, 0) + 1
+
+    def count(self, name: str, labels: str = ''):
+        with self.lock:
+            values = self.counters.setdefault(name, {})
+            values[labels] = values.get(labels, 0) + 1
+
+    def render(self, gauges: dict[str, dict[str, float]] = None, counters: dict[str, dict[str, float]] = None) -> str:
+        # 'gauges' and 'counters' are values owned by other components (caches, executor): name -> {labels: value}.
+        lines = []
+        with self.lock:
+            lines += ['# HELP atp_stage_duration_seconds Time spent in each handler stage.',
+                      '# TYPE atp_stage_duration_seconds histogram']
+            for stage, histogram in sorted(self.stage_latency.items()):
+                lines += histogram.render('atp_stage_duration_seconds', f'stage="{stage}"')
+
+            lines += ['# HELP atp_request_duration_seconds Request latency per route.',
+                      '# TYPE atp_request_duration_seconds histogram']
+            for route, histogram in sorted(self.request_latency.items()):
+                lines += histogram.render('atp_request_duration_seconds', f'route="{route}"')
+
+            for name, help_text, counts in (('atp_requests_total', 'Requests per route and status.', self.requests),
+                                            ('atp_request_errors_total', 'Responses with a 4xx or 5xx status.',
+                                             self.errors)):
+                lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+                for (route, method, status), count in sorted(counts.items()):
+                    lines.append(f'{name}{{route="{route}",method="{method}",status="{status}"}} {count}')
+            counters = {**{name: dict(values) for name, values in self.counters.items()}, **(counters or {})}
+
+        for metric_type, metrics in (('gauge', gauges or {}), ('counter', counters)):
+            for name, values in metrics.items():
+                lines.append(f'# TYPE {name} {metric_type}')
+                for labels, value in values.items():
+                    lines.append(f'{name}{{{labels}}} {value}' if labels else f'{name} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+
+# One registry per process. With several workers each one reports its own values.
+service_metrics = Metrics()
@@ -0,0 +1,91 @@
+import re
+from bisect import bisect_left
+
+import numpy as np
+
+'''
+In-memory search over the player names in player_index_df, used for autocomplete and for "did you mean"
+suggestions when a lookup fails.
+
+Prefix queries use a sorted array of search keys. Each name is stored once for every word it contains, starting at
+that word, so both "nad" and "rafael" style queries land on a range of the array found by bisection. Fuzzy queries
+use a trigram index: every trigram maps to the array of names containing it, and a name's score is the Dice
+coefficient between its trigrams and the query's.
+'''
+
+
+class PlayerNameIndex:
+    def __init__(self, names: list[str], min_similarity= 0.3):
+        # Duplicate names are only listed once.
+        self.names = list(dict.fromkeys(names))
+        self.min_similarity = min_similarity
+        keys = [self.search_key(name) for name in self.names]
+
+        prefix_entries = sorted((key[start:], position)
+                                for position, key in enumerate(keys) for start in self.word_starts(key))
+        self.prefix_keys = [key for key, _ in prefix_entries]
+        self.prefix_positions = [position for _, position in prefix_entries]
+
+        postings = {}
+        self.trigram_counts = np.zeros(len(self.names), dtype=np.int32)
+        for position, key in enumerate(keys):
+            trigrams = self.trigrams(key)
+            self.trigram_counts[position] = len(trigrams)
+            for trigram in trigrams:
+                postings.setdefault(trigram, []).append(position)
+        self.postings = {trigram: np.array(positions, dtype=np.int32) for trigram, positions in postings.items()}
+
+    @staticmethod
+    def search_key(name: str) -> str:
+        # Case, dots and extra spaces are ignored, so "nadal r" finds "Nadal R.".
+        return ' '.join(re.sub(r'[^\w\s-]', ' ', name.lower()).split())
+
+    @staticmethod
+    def word_starts(key: str) -> list[int]:
+        return [0] + [i + 1 for i, char in enumerate(key) if char in ' -']
+
+    @staticmethod
+    def trigrams(key: str) -> set[str]:
+        # Padded so short names and the first letters of a name still produce trigrams.
+        padded = f'  {key} '
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+    def prefix_search(self, query: str, limit: int) -> list[str]:
+        key = self.search_key(query)
+        if not key:
+            return []
+
+        positions = []
+        i = bisect_left(self.prefix_keys, key)
+        while i < len(self.prefix_keys) and self.prefix_keys[i].startswith(key) and len(positions) < limit:
+            if self.prefix_positions[i] not in positions:
+                positions.append(self.prefix_positions[i])
+            i += 1
+        return [self.names[position] for position in positions]
+
+    def fuzzy_search(self, query: str, limit: int) -> list[str]:
+        query_trigrams = self.trigrams(self.search_key(query))
+        matched_postings = [self.postings[trigram] for trigram in query_trigrams if trigram in self.postings]
+        if not matched_postings:
+            return []
+
+        shared = np.bincount(np.concatenate(matched_postings), minlength=len(self.names))
+        scores = 2 * shared / (len(query_trigrams) + self.trigram_counts)
+        candidates = np.flatnonzero(scores >= self.min_similarity)
+        # Best score first. Ties keep the order of player_index_df.
+        best = candidates[np.argsort(-scores[candidates], kind='stable')[:limit]]
+        return [self.names[position] for position in best]
+
+    def search(self, query: str, limit= 10) -> list[str]:
+        # Prefix matches first, since that's what autocomplete is typed against. Fuzzy matches fill the rest.
+        results = self.prefix_search(query, limit)
+        if len(results) < limit:
+            for name in self.fuzzy_search(query, limit):
+                if name not in results:
+                    results.append(name)
+                    if len(results) == limit:
+                        break
+        return results
+
+    def suggest(self, query: str, limit= 3) -> list[str]:
+        return self.fuzzy_search(query, limit)
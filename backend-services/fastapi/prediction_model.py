@@ -1,26 +1,120 @@
 import os
+import json
+import hashlib
+import time
+from collections import Counter
+from typing import Optional
+from datetime import datetime, timezone
+
+import numpy as np
 import pandas as pd
-# import numpy as np
 # from sklearn.preprocessing import LabelEncoder
 # from sklearn.metrics import accuracy_score
 # from google.cloud import storage
-from sklearn.model_selection import train_test_split
-from sklearn.ensemble import RandomForestClassifier
+# joblib and sklearn are imported where they are used. They are the slowest imports here and the
+# API only needs them once the model is loaded.
+
+from response_cache import ResponseCache
+from player_search import PlayerNameIndex
+from metrics import service_metrics
+from flat_forest import FlatForest, HybridForest
+from table_schema import TABLE_DTYPES
+
+
+# Bump when the layout of the saved artifact changes so old files are retrained instead of misread.
+MODEL_ARTIFACT_VERSION = 1
+
+# Values of the INFERENCE_ENGINE environment variable, see ApiRequestHandler.set_model.
+INFERENCE_ENGINES = ('flat', 'hybrid', 'sklearn')
 
 
 class ModelOperations:
-    def __init__(self):
+    def __init__(self, table_format= None, tables_dir= None, previous= None):
         script_dir = os.path.dirname(os.path.realpath(__file__))
-        model_df_path = os.path.join(script_dir, 'tables', 'model_df.csv')
-        player_index_df_path = os.path.join(script_dir, 'tables', 'player_index_df.csv')
-        court_surface_index_df_path = os.path.join(script_dir, 'tables', 'court_surface_index_df.csv')
+        # Other directories are used by the benchmarks, which load generated tables.
+        self.tables_dir = tables_dir or os.path.join(script_dir, 'tables')
+        # 'feather' (memory-mapped Arrow IPC) or 'csv'. By default feather is used when it has been exported.
+        self.table_format = table_format or self.detect_table_format()
+        self.model_df_path = self.table_path('model_df')
+        self.player_index_df_path = self.table_path('player_index_df')
+        self.court_surface_index_df_path = self.table_path('court_surface_index_df')
+        self.model_artifact_path = os.path.join(self.tables_dir, f'model_v{MODEL_ARTIFACT_VERSION}.joblib')
+        self.model_metadata_path = os.path.join(self.tables_dir, f'model_v{MODEL_ARTIFACT_VERSION}.json')
+        self.model = None
+        self.model_metadata = None
+        self.feature_columns = None
+        # Seconds spent in each startup phase, reported by the API's readiness probe.
+        self.startup_timings = {}
+
+        # 'previous' is the handler being replaced by a reload. Its indexes are reused when matches were only appended.
+        self.load_tables(previous)
+
+    def detect_table_format(self) -> str:
+        if os.path.exists(os.path.join(self.tables_dir, 'model_df.feather')):
+            return 'feather'
+        return 'csv'
+
+    def table_path(self, table_name: str) -> str:
+        return os.path.join(self.tables_dir, f'{table_name}.{self.table_format}')
+
+    def read_table(self, file_path: str, table_dtypes: dict[str, str]) -> pd.DataFrame:
+        if self.table_format == 'feather':
+            # Imported here so pyarrow is only needed when feather tables are used.
+            from pyarrow import feather
+            # Memory-mapped read. split_blocks lets numeric columns without nulls be converted without a copy.
+            df = feather.read_table(file_path, memory_map=True).to_pandas(split_blocks=True)
+        else:
+            df = pd.read_csv(file_path)
 
-        self.model_df = pd.read_csv(model_df_path)
-        self.player_index_df = pd.read_csv(player_index_df_path)
-        self.court_surface_index_df = pd.read_csv(court_surface_index_df_path)
+        # Only cast columns that differ, so the memory-mapped feather columns aren't copied.
+        casts = {column: dtype for column, dtype in table_dtypes.items()
+                 if column in df.columns and df[column].dtype != dtype}
+        if casts:
+            df = df.astype(casts)
+
+        return df
+
+    def load_tables(self, previous= None):
+        start = time.perf_counter()
+        self.model_df = self.read_table(self.model_df_path, TABLE_DTYPES['model_df'])
+        self.player_index_df = self.read_table(self.player_index_df_path, TABLE_DTYPES['player_index_df'])
+        self.court_surface_index_df = self.read_table(self.court_surface_index_df_path,
+                                                      TABLE_DTYPES['court_surface_index_df'])
         #self.model_df = self.read_read_csv_from_gcs("atp-winner-predict", "tables/model_df.csv")
         #self.player_index_df = self.read_read_csv_from_gcs("atp-winner-predict", "tables/player_index_df.csv")
         #self.court_surface_index_df = self.read_read_csv_from_gcs("atp-winner-predict", "tables/court_surface_index_df.csv")
+        self.startup_timings['load_tables'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        self.build_lookup_indexes()
+        row_offset = self.appended_row_offset(previous) if previous is not None else None
+        if row_offset is None:
+            self.build_headtohead_index()
+            self.build_player_stats()
+        else:
+            self.append_matches(previous, row_offset)
+        self.startup_timings['build_indexes'] = time.perf_counter() - start
+
+    def build_lookup_indexes(self):
+        # Hashed name <-> index maps so lookups don't scan the tables on every request.
+        # Must be rebuilt whenever the tables are reloaded.
+        self.player_index_by_name = self.normalized_index(self.player_index_df['Player'], self.player_index_df['Index'])
+        self.player_name_by_index = dict(zip(self.player_index_df['Index'].tolist(), self.player_index_df['Player']))
+        # Prefix and fuzzy name search for autocomplete and "did you mean" suggestions.
+        self.player_search_index = PlayerNameIndex(self.player_index_df['Player'].tolist())
+        self.surface_index_by_name = self.normalized_index(self.court_surface_index_df['CourtSurface'],
+                                                           self.court_surface_index_df['Index'])
+        self.surface_name_by_index = dict(zip(self.court_surface_index_df['Index'].tolist(),
+                                              self.court_surface_index_df['CourtSurface']))
+
+    @staticmethod
+    def normalize_name(name: str) -> str:
+        return name.strip().lower()
+
+    def normalized_index(self, names: pd.Series, indexes: pd.Series) -> dict[str, int]:
+        normalized_names = [self.normalize_name(name) for name in names]
+        # Reversed so the first occurrence of a duplicate name wins, same as the old row scan.
+        return dict(zip(reversed(normalized_names), reversed(indexes.tolist())))
 
     def preprocessing(self, df):
         x = df.drop(columns=['Target', 'MatchID', 'WinnerLoserHash'])
@@ -29,6 +123,9 @@ class ModelOperations:
         return x, y
 
     def model_evaluation(self):
+        from sklearn.model_selection import train_test_split
+        from sklearn.ensemble import RandomForestClassifier
+
         x, y = self.preprocessing(self.model_df)
         # I have just used standard values for these:
         x_train, x_test, y_train, y_test = train_test_split(x, y, test_size=0.2, random_state=42)
@@ -52,113 +149,295 @@ class ModelOperations:
         # pred = model_1.predict(x_test)
         # print(accuracy_score(y_test, pred))
 
-        return model_1
+        return model_1, x_train
+
+    def data_hash(self) -> str:
+        # Fingerprint of the training table. Used to detect an artifact that was fitted on other data.
+        row_hashes = pd.util.hash_pandas_object(self.model_df, index=False).values
+        return hashlib.sha256(row_hashes.tobytes()).hexdigest()
+
+    def train_model(self):
+        import joblib
+
+        # Training stage: fit once and persist the model next to the tables so the API only has to load it.
+        model, x_train = self.model_evaluation()
+        metadata = {
+            'artifact_version': MODEL_ARTIFACT_VERSION,
+            'feature_columns': list(x_train.columns),
+            'training_rows': len(x_train),
+            'data_hash': self.data_hash(),
+            'trained_at': datetime.now(timezone.utc).isoformat(),
+        }
+        # Written to a temporary file and renamed over the old one, so a process loading the artifact at the same
+        # time reads either the old or the new model, never a half-written file. The pid keeps two processes
+        # retraining at once from writing to the same temporary file.
+        temp_artifact_path = f"{self.model_artifact_path}.{os.getpid()}.tmp"
+        joblib.dump({'model': model, 'metadata': metadata}, temp_artifact_path)
+        os.replace(temp_artifact_path, self.model_artifact_path)
+        # Readable copy of the metadata so the artifact can be inspected without unpickling it.
+        temp_metadata_path = f"{self.model_metadata_path}.{os.getpid()}.tmp"
+        with open(temp_metadata_path, 'w') as file:
+            json.dump(metadata, file, indent=2)
+        os.replace(temp_metadata_path, self.model_metadata_path)
+        print(f"Model artifact exported to {self.model_artifact_path}")
+
+        self.set_model(model, metadata)
+
+    def load_model(self):
+        import joblib
+
+        start = time.perf_counter()
+        if not os.path.exists(self.model_artifact_path):
+            print(f"No model artifact found at {self.model_artifact_path}. Training a new one.")
+            self.train_model()
+        else:
+            artifact = joblib.load(self.model_artifact_path)
+            metadata = artifact['metadata']
+            if metadata.get('artifact_version') != MODEL_ARTIFACT_VERSION or metadata.get('data_hash') != self.data_hash():
+                print("Model artifact is out of date with the loaded tables. Retraining.")
+                self.train_model()
+            else:
+                self.set_model(artifact['model'], metadata)
+        self.startup_timings['load_model'] = time.perf_counter() - start
+
+    def set_model(self, model, metadata: dict):
+        # Single-row predictions are faster without joblib dispatching the trees over every core.
+        model.set_params(n_jobs=1)
+        self.model = model
+        self.model_metadata = metadata
+        self.feature_columns = metadata['feature_columns']
+
+    def build_headtohead_index(self):
+        # Sparse player x player counts of matches won by the Player1 side (Target == 1), keyed by
+        # (Player1, Player2) and (Player1, Player2, CourtSurface). Plus the row positions each player
+        # appears at, so a player's matches can be read without scanning model_df.
+        self.headtohead_wins = Counter()
+        self.headtohead_wins_by_surface = Counter()
+        # The pair counts again as a Series, so the batch lookup is one vectorized reindex.
+        self.headtohead_wins_series = pd.Series([], dtype=np.int64, index=pd.MultiIndex.from_arrays(
+            [np.array([], dtype=np.int32), np.array([], dtype=np.int32)], names=['Player1', 'Player2']))
+        self.player1_rows = {}
+        self.player2_rows = {}
+        self.update_headtohead_index(self.model_df, row_offset=0)
+
+    def update_headtohead_index(self, matches: pd.DataFrame, row_offset: int):
+        # Adds the counts and row positions of 'matches', which start at 'row_offset' in model_df.
+        wins = matches[matches['Target'] == 1]
+        pair_wins = wins.groupby(['Player1', 'Player2']).size()
+        self.headtohead_wins.update(pair_wins.to_dict())
+        self.headtohead_wins_by_surface.update(wins.groupby(['Player1', 'Player2', 'CourtSurface']).size().to_dict())
+        self.headtohead_wins_series = self.headtohead_wins_series.add(pair_wins, fill_value=0).astype(np.int64)
+
+        for column, player_rows in (('Player1', self.player1_rows), ('Player2', self.player2_rows)):
+            for player_index, rows in matches.groupby(column).indices.items():
+                rows = rows + row_offset
+                if player_index in player_rows:
+                    rows = np.concatenate([player_rows[player_index], rows])
+                player_rows[player_index] = rows
+
+    def appended_row_offset(self, previous) -> Optional[int]:
+        # Number of rows of the previous model_df if the new one is those rows plus appended matches, as written by
+        # an incremental build (PrepareDataframe(incremental=True) in scraper.py). None if the tables were rebuilt.
+        # An incremental build keeps every earlier match and its encoding. It only refreshes the TotalWins and
+        # HeadToHead columns of rows that involve a player with new matches.
+        previous_df = previous.model_df
+        row_offset = len(previous_df)
+        if (len(self.model_df) < row_offset or list(self.model_df.columns) != list(previous_df.columns)
+                or not self.court_surface_index_df.equals(previous.court_surface_index_df)):
+            return None
+        new_players = np.unique(np.concatenate([self.model_df['Player1'].to_numpy()[row_offset:],
+                                                self.model_df['Player2'].to_numpy()[row_offset:]]))
+        unchanged_rows = ~(previous_df['Player1'].isin(new_players) | previous_df['Player2'].isin(new_players)).to_numpy()
+        for column in previous_df.columns:
+            new_values = self.model_df[column].to_numpy()[:row_offset]
+            previous_values = previous_df[column].to_numpy()
+            if column not in ('TotalWins_Player1', 'TotalWins_Player2', 'HeadToHead'):
+                if not np.array_equal(new_values, previous_values):
+                    return None
+            elif not np.array_equal(new_values[unchanged_rows], previous_values[unchanged_rows]):
+                return None
+        return row_offset
+
+    def append_matches(self, previous, row_offset: int):
+        # Incremental rebuild: starts from the indexes of the handler being replaced and adds the matches from
+        # 'row_offset' on. The previous handler keeps serving while this runs, so its indexes are copied, not changed.
+        # Only the stats of the players in the new matches are recomputed.
+        self.headtohead_wins = previous.headtohead_wins.copy()
+        self.headtohead_wins_by_surface = previous.headtohead_wins_by_surface.copy()
+        self.headtohead_wins_series = previous.headtohead_wins_series
+        self.player1_rows = dict(previous.player1_rows)
+        self.player2_rows = dict(previous.player2_rows)
+        new_matches = self.model_df.iloc[row_offset:]
+        self.update_headtohead_index(new_matches, row_offset)
+
+        players = np.unique(np.concatenate([new_matches['Player1'].to_numpy(), new_matches['Player2'].to_numpy()]))
+        self.player_stats = previous.player_stats
+        self.build_player_stats(players)
+
+    def player_rows(self, player_index: int) -> tuple[np.ndarray, np.ndarray]:
+        # Row positions in model_df where the player is listed as Player1 and as Player2.
+        empty = np.array([], dtype=np.int64)
+        return self.player1_rows.get(player_index, empty), self.player2_rows.get(player_index, empty)
+
+    def player_matches(self, player_indexes) -> pd.DataFrame:
+        # Every match of the given players, in model_df order, read by row position.
+        rows = [row_positions for player_index in player_indexes for row_positions in self.player_rows(player_index)]
+        return self.model_df.iloc[np.unique(np.concatenate(rows))] if rows else self.model_df.iloc[:0]
+
+    def build_player_stats(self, players= None):
+        # Per-player summary table (indexed by player index) so a stats lookup is a single row read.
+        # Same values as scanning model_df per player: total wins from the player's first match, nemesis is the
+        # first opponent with the highest head-to-head (own Player1 rows first, then Player2 rows with abs value),
+        # favorite surface is the most won on (lowest surface index on ties, like mode()).
+        # With 'players', only their rows are recomputed from their own matches and the others are kept.
+        df = self.model_df if players is None else self.player_matches(players)
+        total_wins = df.groupby('Player1')['TotalWins_Player1'].first().combine_first(
+            df.groupby('Player2')['TotalWins_Player2'].first())
+
+        head_to_head = pd.DataFrame({
+            'Player': np.concatenate([df['Player1'].to_numpy(), df['Player2'].to_numpy()]),
+            'Opponent': np.concatenate([df['Player2'].to_numpy(), df['Player1'].to_numpy()]),
+            'HeadToHead': np.concatenate([df['HeadToHead'].to_numpy(), np.abs(df['HeadToHead'].to_numpy())]),
+        })
+        nemesis_rows = head_to_head.groupby('Player')['HeadToHead'].idxmax()
+        nemesis = pd.Series(head_to_head['Opponent'].to_numpy()[nemesis_rows.to_numpy()], index=nemesis_rows.index)
+
+        player1_won = df['Target'] == 1
+        wins = pd.DataFrame({
+            'Player': np.concatenate([df.loc[player1_won, 'Player1'].to_numpy(), df.loc[~player1_won, 'Player2'].to_numpy()]),
+            'CourtSurface': np.concatenate([df.loc[player1_won, 'CourtSurface'].to_numpy(),
+                                            df.loc[~player1_won, 'CourtSurface'].to_numpy()]),
+        })
+        if players is not None:
+            # The opponents in these matches only have some of their matches here, so only the players' wins count.
+            wins = wins[wins['Player'].isin(players)]
+        surface_indexes = sorted(self.surface_name_by_index)
+        surface_wins = pd.crosstab(wins['Player'], wins['CourtSurface']).reindex(columns=surface_indexes, fill_value=0)
+
+        player_stats = pd.DataFrame({'TotalWins': total_wins, 'Nemesis': nemesis})
+        # -1 for players without a win.
+        player_stats['FavoriteSurface'] = surface_wins[surface_wins.sum(axis=1) > 0].idxmax(axis=1)
+        player_stats['FavoriteSurface'] = player_stats['FavoriteSurface'].fillna(-1)
+        for surface_index in surface_indexes:
+            surface_column = 'Wins' + self.surface_name_by_index[surface_index].replace(' ', '')
+            player_stats[surface_column] = surface_wins[surface_index]
+        player_stats = player_stats.fillna(0).astype('int64')
+        if players is not None:
+            # The opponents' rows are incomplete for the same reason and are left out.
+            player_stats = pd.concat([self.player_stats.drop(players, errors='ignore'),
+                                      player_stats.loc[players]]).sort_index()
+        self.player_stats = player_stats
 
     def player_index_lookup(self, player_name: str) -> int:
-        player_name_normalized = player_name.strip().lower()
-        normalized_players = self.player_index_df['Player'].str.strip().str.lower()
-        
-        player_index = self.player_index_df[normalized_players == player_name_normalized]['Index'].values
-        if len(player_index) == 0:
-            raise ValueError(f"No match found for '{player_name}'. Please check spelling and input format.")
-        return player_index[0]
+        player_index = self.player_index_by_name.get(self.normalize_name(player_name))
+        if player_index is None:
+            message = f"No match found for '{player_name}'. Please check spelling and input format."
+            suggestions = self.player_search_index.suggest(player_name)
+            if suggestions:
+                message += f" Did you mean: {', '.join(suggestions)}?"
+            raise ValueError(message)
+        return player_index
+
+    def player_search(self, query: str, limit= 10) -> list[str]:
+        return self.player_search_index.search(query, limit)
 
     def player_name_lookup(self, player_index: int) -> str:
-        player_name = self.player_index_df[self.player_index_df['Index'] == player_index]['Player'].values
-
-        return player_name[0]
+        return self.player_name_by_index[player_index]
 
     def court_surface_index_lookup(self, surface_name: str) -> int:
         # Lookup court surface with its index value in 'court_surface_index.csv'.
-        surface_index_lookup = \
-            self.court_surface_index_df[self.court_surface_index_df['CourtSurface'] == surface_name]['Index'].values
-        if len(surface_index_lookup) == 0:
+        surface_index = self.surface_index_by_name.get(self.normalize_name(surface_name))
+        if surface_index is None:
             raise ValueError(f"No match found for '{surface_name}'. Please check spelling and input format.")
-        else:
+        return surface_index
 
-            return surface_index_lookup[0]
-        
     def court_surface_name_lookup(self, surface_index: int) -> str:
-        surface_name_lookup = self.court_surface_index_df[self.court_surface_index_df['Index'] == surface_index]['CourtSurface'].values
-
-        return surface_name_lookup[0]
-
-    def calculate_headtohead(self, player1_index: int, player2_index: int) -> int:
-        # Grab all rows where player1_index vs player2_index and vice versa.
-        player1_vs_player2 = self.model_df[
-            ((self.model_df['Player1'] == player1_index) & (self.model_df['Player2'] == player2_index)) |
-            ((self.model_df['Player1'] == player2_index) & (self.model_df['Player2'] == player1_index))
-            ]
-        # Count the number of rows where each player has Target == 1 means Player1 wins.
-        # Returns a tuple (num_rows, num_columns). .shape[0] accesses the first element of the tuple.
-        player1_wins_target1 = (player1_vs_player2[(player1_vs_player2['Player1'] == player1_index) &
-                                                   (player1_vs_player2['Target'] == 1)]).shape[0]
-        player2_wins_target1 = (player1_vs_player2[(player1_vs_player2['Player1'] == player2_index) &
-                                                   (player1_vs_player2['Target'] == 1)]).shape[0]
+        return self.surface_name_by_index[surface_index]
+
+    def calculate_headtohead(self, player1_index: int, player2_index: int, court_surface_index: int = None) -> int:
+        # Number of times each player won when listed as Player1 against the other (Target == 1).
+        if court_surface_index is None:
+            player1_wins_target1 = self.headtohead_wins[(player1_index, player2_index)]
+            player2_wins_target1 = self.headtohead_wins[(player2_index, player1_index)]
+        else:
+            player1_wins_target1 = self.headtohead_wins_by_surface[(player1_index, player2_index, court_surface_index)]
+            player2_wins_target1 = self.headtohead_wins_by_surface[(player2_index, player1_index, court_surface_index)]
         headtohead_value = player1_wins_target1 - player2_wins_target1
 
         return headtohead_value
 
-    def predict_winner(self, player1_index: int, player2_index: int, court_surface_index: int) -> int:
-        headtohead_value = self.calculate_headtohead(player1_index, player2_index)
+    def calculate_headtohead_batch(self, player1_indexes: np.ndarray, player2_indexes: np.ndarray) -> np.ndarray:
+        # Same values as calculate_headtohead for every pair, with two reindexes instead of a loop.
+        player1_wins = self.headtohead_wins_series.reindex(
+            pd.MultiIndex.from_arrays([player1_indexes, player2_indexes]), fill_value=0).to_numpy()
+        player2_wins = self.headtohead_wins_series.reindex(
+            pd.MultiIndex.from_arrays([player2_indexes, player1_indexes]), fill_value=0).to_numpy()
+
+        return player1_wins - player2_wins
+
+    def model_input(self, player1_indexes, player2_indexes, headtohead_values, court_surface_indexes) -> pd.DataFrame:
+        # Feature rows for the model, one per matchup. The TotalWins features are unknown at prediction time.
         # players_hash = self.hash_players_input(player1_index, player2_index)
-        # Input data must follow the order in which they appear in the dataframe or else specify with 'columns='.
         input_data = pd.DataFrame({
-            'Player1': [player1_index],
-            'Player2': [player2_index],
+            'Player1': player1_indexes,
+            'Player2': player2_indexes,
             # 'WinnerLoserHash': [np.nan],
-            'HeadToHead': [headtohead_value],
-            'TotalWins_Player1': [None],
-            'TotalWins_Player2': [None],
-            'CourtSurface': [court_surface_index]
+            'HeadToHead': headtohead_values,
+            'TotalWins_Player1': [None] * len(player1_indexes),
+            'TotalWins_Player2': [None] * len(player1_indexes),
+            'CourtSurface': court_surface_indexes
         })  # columns=['Player1', 'Player2', 'WinnerLoserHash', 'HeadToHead', 'CourtSurface'])
 
-        model = self.model_evaluation()
-        prediction_target = model.predict(input_data)
+        # Match the column order the model was fitted with.
+        return input_data[self.feature_columns]
+
+    def predict_winner(self, player1_index: int, player2_index: int, court_surface_index: int) -> int:
+        headtohead_value = self.calculate_headtohead(player1_index, player2_index)
+
+        if self.model is None:
+            self.load_model()
+        input_data = self.model_input([player1_index], [player2_index], [headtohead_value], [court_surface_index])
+        prediction_target = self.model.predict(input_data)
 
         return prediction_target
 
+    def predict_winner_batch(self, player1_indexes: np.ndarray, player2_indexes: np.ndarray,
+                             court_surface_indexes: np.ndarray) -> np.ndarray:
+        # Scores every matchup with one model call. Returns the probability that Player1 wins for each row.
+        with service_metrics.stage('headtohead'):
+            headtohead_values = self.calculate_headtohead_batch(player1_indexes, player2_indexes)
+
+        if self.model is None:
+            self.load_model()
+        with service_metrics.stage('model'):
+            input_data = self.model_input(player1_indexes, player2_indexes, headtohead_values, court_surface_indexes)
+            probabilities = self.model.predict_proba(input_data)
+        player1_win_column = list(self.model.classes_).index(1)
+
+        return probabilities[:, player1_win_column]
+
     def winner_name(self, player1_index: int, player2_index: int, prediction: int) -> str:
         predicted_winner_index = player1_index if prediction == 1 else player2_index
-        predicted_winner_name = \
-            self.player_index_df[self.player_index_df['Index'] == predicted_winner_index]['Player'].values[0]
 
-        return predicted_winner_name
+        return self.player_name_lookup(predicted_winner_index)
+
+    def player_summary(self, player_index: int) -> dict:
+        if player_index not in self.player_stats.index:
+            raise ValueError(f"No matches found for '{self.player_name_lookup(player_index)}'.")
+        return self.player_stats.loc[player_index].to_dict()
 
     def total_wins_lookup(self, player_index: int) -> int:
-        player1_match = self.model_df[self.model_df['Player1'] == player_index]
-        if not player1_match.empty:
-            return int(player1_match.iloc[0]['TotalWins_Player1'])
-        
-        player2_match = self.model_df[self.model_df['Player2'] == player_index]
-        if not player2_match.empty:
-            return int(player2_match.iloc[0]['TotalWins_Player2'])
+        return self.player_summary(player_index)['TotalWins']
     
     def nemesis_lookup(self, player_index:int) -> str:
-        player1_matches = self.model_df[self.model_df['Player1'] == player_index]
-        player2_matches = self.model_df[self.model_df['Player2'] == player_index]
-
-        player1_head_to_head = player1_matches[['Player2', 'HeadToHead']]
-        player2_head_to_head = player2_matches[['Player1', 'HeadToHead']]
-        player2_head_to_head.loc[:, 'HeadToHead'] = player2_head_to_head['HeadToHead'].abs()
-
-        player1_head_to_head.columns = ['Opponent', 'HeadToHead']
-        player2_head_to_head.columns = ['Opponent', 'HeadToHead']
-
-        combined_head_to_head = pd.concat([player1_head_to_head, player2_head_to_head])
-
-        nemesis_row = combined_head_to_head.loc[combined_head_to_head['HeadToHead'].idxmax()]
-        nemesis_player_index = nemesis_row['Opponent']
-        nemesis_player = self.player_name_lookup(nemesis_player_index)
+        nemesis_player = self.player_name_lookup(self.player_summary(player_index)['Nemesis'])
 
         return str(nemesis_player)
     
     def favorite_surface(self, player_index:int) -> str:
-        player1_wins = self.model_df[(self.model_df['Player1'] == player_index) & (self.model_df['Target'] == 1)]
-        player2_wins = self.model_df[(self.model_df['Player2'] == player_index) & (self.model_df['Target'] == 0)]
-
-        combined_wins = pd.concat([player1_wins, player2_wins])
-        surface_index = combined_wins['CourtSurface'].mode().iloc[0]
+        surface_index = self.player_summary(player_index)['FavoriteSurface']
+        if surface_index < 0:
+            return "No wins yet"
         surface_name = self.court_surface_name_lookup(surface_index)
 
         return str(surface_name)
@@ -171,26 +450,173 @@ class ModelOperations:
     
 
 class ApiRequestHandler(ModelOperations):
-    def __init__(self):
-        super().__init__()
-        
-    def winner_prediction(self, player1_name: str, player2_name: str, court_surface: str) -> str:
-        player1_index = self.player_index_lookup(player1_name)
-        player2_index = self.player_index_lookup(player2_name)
-        court_surface_index = self.court_surface_index_lookup(court_surface)
-        prediction_target = self.predict_winner(player1_index, player2_index, court_surface_index)
-        predicted_winner_name = self.winner_name(player1_index, player2_index, prediction_target)
+    def __init__(self, table_format= None, tables_dir= None, previous= None):
+        # Responses only depend on the loaded tables and model, so they are cached until either changes.
+        cache_size = int(os.environ.get("RESPONSE_CACHE_SIZE", 10000))
+        cache_ttl = float(os.environ.get("RESPONSE_CACHE_TTL", 3600))
+        self.prediction_cache = ResponseCache('predictions', cache_size, cache_ttl)
+        self.stats_cache = ResponseCache('player_stats', cache_size, cache_ttl)
+        # Trees per chunk for anytime predictions. Checked here so a bad value fails at startup, not per request.
+        self.anytime_chunk_trees = int(os.environ.get("ANYTIME_CHUNK_TREES", 50))
+        if self.anytime_chunk_trees < 1:
+            raise ValueError(f"ANYTIME_CHUNK_TREES must be at least 1, got {self.anytime_chunk_trees}.")
+        self.inference_engine = os.environ.get("INFERENCE_ENGINE", "flat")
+        if self.inference_engine not in INFERENCE_ENGINES:
+            raise ValueError(f"Unknown INFERENCE_ENGINE '{self.inference_engine}'. "
+                             f"Use one of: {', '.join(INFERENCE_ENGINES)}.")
+        self.inference_flat_max_rows = int(os.environ.get("INFERENCE_FLAT_MAX_ROWS", 256))
+        super().__init__(table_format, tables_dir, previous)
+        self.load_model()
+
+    def clear_response_caches(self):
+        self.prediction_cache.clear()
+        self.stats_cache.clear()
+
+    def load_tables(self, previous= None):
+        super().load_tables(previous)
+        self.clear_response_caches()
+
+    def set_model(self, model, metadata: dict):
+        super().set_model(model, metadata)
+        # The forest is exported to flat arrays for inference, with the same predictions. By default ('flat') only the
+        # flat arrays are kept and the sklearn trees are released, which takes the least memory. 'hybrid' keeps both
+        # and hands batches of more than INFERENCE_FLAT_MAX_ROWS rows to sklearn, which is faster at that size.
+        # 'sklearn' doesn't export the forest.
+        if self.inference_engine == "flat":
+            self.model = FlatForest(self.model)
+        elif self.inference_engine == "hybrid":
+            self.model = HybridForest(self.model, self.inference_flat_max_rows)
+        self.clear_response_caches()
 
-        return f"Predicted Winner: {predicted_winner_name}"
+    def winner_prediction(self, player1_name: str, player2_name: str, court_surface: str) -> str:
+        player1_key = self.normalize_name(player1_name)
+        player2_key = self.normalize_name(player2_name)
+        # Both orderings of a matchup share one cache entry. The forest isn't symmetric, so each ordering keeps
+        # its own answer, but both are scored in the same model call and the reversed request is then a hit.
+        cache_key = (tuple(sorted((player1_key, player2_key))), self.normalize_name(court_surface))
+        with service_metrics.stage('cache'):
+            cached_responses = self.prediction_cache.get(cache_key)
+        if cached_responses is not None:
+            return cached_responses[(player1_key, player2_key)]
+
+        with service_metrics.stage('lookup'):
+            player1_index = self.player_index_lookup(player1_name)
+            player2_index = self.player_index_lookup(player2_name)
+            court_surface_index = self.court_surface_index_lookup(court_surface)
+        player1_win_probabilities = self.predict_winner_batch(np.array([player1_index, player2_index]),
+                                                              np.array([player2_index, player1_index]),
+                                                              np.array([court_surface_index] * 2))
+
+        responses = {}
+        with service_metrics.stage('winner_name'):
+            for (first_key, second_key), (first_index, second_index), player1_win_probability in zip(
+                    [(player1_key, player2_key), (player2_key, player1_key)],
+                    [(player1_index, player2_index), (player2_index, player1_index)],
+                    player1_win_probabilities):
+                # Same as model.predict: Player1 wins when its class has the higher probability.
+                prediction_target = 1 if player1_win_probability > 0.5 else 0
+                predicted_winner_name = self.winner_name(first_index, second_index, prediction_target)
+                responses[(first_key, second_key)] = f"Predicted Winner: {predicted_winner_name}"
+        self.prediction_cache.put(cache_key, responses)
+
+        return responses[(player1_key, player2_key)]
     
-    def stats_lookup(self, player_name:str) -> str:
-        player_index = self.player_index_lookup(player_name)
-        total_wins = self.total_wins_lookup(player_index)
-        nemesis = self.nemesis_lookup(player_index)
-        favorite_surface = self.favorite_surface(player_index)
+    def batch_winner_prediction(self, matchups: list[tuple[str, str, str]]) -> list[dict]:
+        # Resolve every name and surface up front. Matchups that fail are reported on their own
+        # and left out of the model call, so one bad entry does not fail the whole batch.
+        results = [None] * len(matchups)
+        valid_positions = []
+        encoded_matchups = []
+        with service_metrics.stage('lookup'):
+            for position, (player1_name, player2_name, court_surface) in enumerate(matchups):
+                result = {'player1': player1_name, 'player2': player2_name, 'court_surface': court_surface}
+                player1_index = self.player_index_by_name.get(self.normalize_name(player1_name))
+                player2_index = self.player_index_by_name.get(self.normalize_name(player2_name))
+                court_surface_index = self.surface_index_by_name.get(self.normalize_name(court_surface))
+                for name, index in ((player1_name, player1_index), (player2_name, player2_index),
+                                    (court_surface, court_surface_index)):
+                    if index is None:
+                        result['error'] = f"No match found for '{name}'. Please check spelling and input format."
+                        break
+                else:
+                    valid_positions.append(position)
+                    encoded_matchups.append((player1_index, player2_index, court_surface_index))
+                results[position] = result
+
+        if encoded_matchups:
+            player1_indexes, player2_indexes, court_surface_indexes = (np.array(column) for column in zip(*encoded_matchups))
+            player1_win_probabilities = self.predict_winner_batch(player1_indexes, player2_indexes, court_surface_indexes)
+            winner_indexes = np.where(player1_win_probabilities > 0.5, player1_indexes, player2_indexes)
+            with service_metrics.stage('winner_name'):
+                for position, winner_index, player1_win_probability in zip(valid_positions, winner_indexes,
+                                                                          player1_win_probabilities):
+                    results[position]['predicted_winner'] = self.player_name_lookup(winner_index)
+                    results[position]['win_probability'] = float(max(player1_win_probability,
+                                                                     1 - player1_win_probability))
+
+        return results
+
+    def anytime_winner_prediction(self, player1_name: str, player2_name: str, court_surface: str,
+                                  deadline: float = None, min_margin: float = None) -> dict:
+        # Evaluates the forest in chunks of trees and stops early, see FlatForest.predict_proba_anytime. 'deadline'
+        # is a time.perf_counter() value. Not cached: the answer depends on the time left and the margin asked for.
+        with service_metrics.stage('lookup'):
+            player1_index = self.player_index_lookup(player1_name)
+            player2_index = self.player_index_lookup(player2_name)
+            court_surface_index = self.court_surface_index_lookup(court_surface)
+        with service_metrics.stage('headtohead'):
+            headtohead_value = self.calculate_headtohead(player1_index, player2_index)
+
+        with service_metrics.stage('model'):
+            input_data = self.model_input([player1_index], [player2_index], [headtohead_value], [court_surface_index])
+            if hasattr(self.model, 'predict_proba_anytime'):
+                probabilities, trees_used, stop_reason = self.model.predict_proba_anytime(
+                    input_data, self.anytime_chunk_trees, min_margin, deadline)
+                trees_total = self.model.n_trees
+            else:
+                # INFERENCE_ENGINE=sklearn: no early stopping, the whole forest is evaluated.
+                probabilities = self.model.predict_proba(input_data)
+                trees_total = len(self.model.estimators_)
+                trees_used, stop_reason = trees_total, 'complete'
+        service_metrics.count('atp_anytime_predictions_total', f'stop_reason="{stop_reason}"')
+
+        player1_win_probability = probabilities[0, list(self.model.classes_).index(1)]
+        winner_index = player1_index if player1_win_probability > 0.5 else player2_index
+        return {
+            'predicted_winner': self.player_name_lookup(winner_index),
+            'win_probability': float(max(player1_win_probability, 1 - player1_win_probability)),
+            'trees_used': trees_used,
+            'trees_total': trees_total,
+            'stop_reason': stop_reason,
+        }
 
-        return f"""Total Wins: {total_wins}
+    def stats_lookup(self, player_name:str) -> str:
+        cache_key = self.normalize_name(player_name)
+        with service_metrics.stage('cache'):
+            cached_stats = self.stats_cache.get(cache_key)
+        if cached_stats is not None:
+            return cached_stats
+
+        with service_metrics.stage('lookup'):
+            player_index = self.player_index_lookup(player_name)
+        with service_metrics.stage('stats'):
+            summary = self.player_summary(player_index)
+            total_wins = summary['TotalWins']
+            nemesis = self.player_name_lookup(summary['Nemesis'])
+            if summary['FavoriteSurface'] < 0:
+                favorite_surface = "No wins yet"
+            else:
+                favorite_surface = self.court_surface_name_lookup(summary['FavoriteSurface'])
+
+        player_stats = f"""Total Wins: {total_wins}
 
                     Nemesis: {nemesis}
 
-                    Favorite Surface: {favorite_surface}"""
\ No newline at end of file
+                    Favorite Surface: {favorite_surface}"""
+        self.stats_cache.put(cache_key, player_stats)
+
+        return player_stats
+
+
+if __name__ == "__main__":
+    ModelOperations().train_model()
@@ -0,0 +1,63 @@
+import time
+import threading
+from collections import OrderedDict
+
+from metrics import service_metrics
+
+'''
+Bounded LRU cache with a TTL, used by ApiRequestHandler for prediction and stats responses.
+Thread safe, since the handler runs on the HandlerExecutor threads.
+
+Hits, misses and evictions are also counted in service_metrics, labelled with the cache's name. A reload replaces the
+handler and its caches, and the Prometheus counters must keep counting up across that.
+'''
+
+
+class ResponseCache:
+    def __init__(self, name: str, max_size: int, ttl: float):
+        self.labels = f'cache="{name}"'
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expires_at, value)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        # Returns None on a miss, so None can't be cached as a value.
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                service_metrics.count('atp_response_cache_misses_total', self.labels)
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            service_metrics.count('atp_response_cache_hits_total', self.labels)
+            return entry[1]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+                service_metrics.count('atp_response_cache_evictions_total', self.labels)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self) -> dict[str, int]:
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
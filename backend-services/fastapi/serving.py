@@ -0,0 +1,282 @@
+import gc
+import os
+import json
+import mmap
+import socket
+import signal
+import struct
+import time
+import multiprocessing
+from datetime import datetime, timezone
+
+import uvicorn
+
+from table_schema import TABLE_DTYPES
+
+'''
+Multi-worker serving for api.py.
+
+uvicorn's own '--workers' starts every worker as a fresh process, so each one loads its own copy of the tables
+and the fitted forest. Here the ApiRequestHandler is loaded once in the parent and the workers are forked from it.
+The model's tree arrays are then shared copy-on-write, and feather tables are shared anyway since they're
+memory-mapped. Every worker reports its memory on startup: PSS splits shared pages between the processes using
+them, so the sum of PSS over all workers is the real footprint.
+
+Reloads (SIGHUP to the parent, sent by POST /admin/reload in any worker, or a change to the tables when
+RELOAD_WATCH_SECONDS is set) are done once in the parent: it loads a new handler, forks a new set of workers from it
+and stops the old ones gracefully, so every worker serves the same tables and model and they stay shared.
+'''
+
+TABLE_NAMES = tuple(TABLE_DTYPES)
+
+# Set in the parent before forking. The api lifespan uses it instead of loading a new handler.
+preloaded_handler = None
+# Pid of the serving parent, set when workers are forked. Workers send it SIGHUP to ask for a reload.
+parent_pid = None
+# Shared by the parent and its workers, so /admin/reload reports the same state in every worker.
+reload_status = None
+
+
+class ReloadStatus:
+    # Reload state as JSON in an anonymous shared mapping. Forked workers inherit the mapping and the lock, so they
+    # see the parent's updates. Also used as is by a single process.
+    def __init__(self, size: int = 4096):
+        self.buffer = mmap.mmap(-1, size)
+        self.lock = multiprocessing.Lock()
+        self.set({"state": "idle"})
+
+    def get(self) -> dict:
+        with self.lock:
+            length = struct.unpack_from('I', self.buffer, 0)[0]
+            return json.loads(self.buffer[4:4 + length])
+
+    def set(self, status: dict):
+        data = json.dumps(status).encode()[:len(self.buffer) - 4]
+        with self.lock:
+            struct.pack_into('I', self.buffer, 0, len(data))
+            self.buffer[4:4 + len(data)] = data
+
+    def update(self, **fields):
+        self.set({**self.get(), **fields})
+
+    def start(self):
+        self.set({"state": "running", "started_at": datetime.now(timezone.utc).isoformat()})
+
+    def finish(self, error: str = None):
+        if error is None:
+            self.update(state="done", finished_at=datetime.now(timezone.utc).isoformat())
+        else:
+            self.update(state="failed", error=error)
+
+
+class TablesWatcher:
+    # Polled for changes to the table files. A change is only reported once two polls in a row see the same files,
+    # so a reload doesn't start while PrepareDataframe is still writing the tables one after another.
+    def __init__(self, tables_dir: str):
+        self.tables_dir = tables_dir
+        self.loaded = self.signature()
+        self.pending = self.loaded
+
+    def signature(self) -> tuple:
+        entries = []
+        for name in sorted(os.listdir(self.tables_dir)):
+            if name.split('.')[0] not in TABLE_NAMES or name.endswith('.tmp'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.tables_dir, name))
+            except FileNotFoundError:
+                continue
+            entries.append((name, stat.st_mtime_ns, stat.st_size))
+        return tuple(entries)
+
+    def changed(self) -> bool:
+        current = self.signature()
+        settled = current == self.pending and current != self.loaded
+        self.pending = current
+        if settled:
+            self.loaded = current
+        return settled
+
+    def reset(self):
+        # After a reload, whatever triggered it: the files now on disk are the loaded ones.
+        self.loaded = self.pending = self.signature()
+
+    @classmethod
+    def from_environment(cls, tables_dir: str):
+        interval = float(os.environ.get("RELOAD_WATCH_SECONDS", 0))
+        if interval <= 0:
+            return None, 0
+        return cls(tables_dir), interval
+
+
+def worker_memory_report() -> dict[str, float]:
+    # Values in MB. smaps_rollup is Linux only, other Unix platforms just get peak RSS and Windows gets nothing.
+    try:
+        with open('/proc/self/smaps_rollup') as file:
+            fields = {}
+            for line in file:
+                key, _, value = line.partition(':')
+                if key in ('Rss', 'Pss', 'Shared_Clean', 'Shared_Dirty', 'Private_Clean', 'Private_Dirty'):
+                    fields[key] = int(value.split()[0]) / 1024
+        return {
+            'rss_mb': fields['Rss'],
+            'pss_mb': fields['Pss'],
+            'shared_mb': fields['Shared_Clean'] + fields['Shared_Dirty'],
+            'private_mb': fields['Private_Clean'] + fields['Private_Dirty'],
+        }
+    except OSError:
+        pass
+
+    try:
+        # 'resource' is Unix only, so it's imported here and api.py still imports on Windows.
+        import resource
+    except ImportError:
+        return {}
+    # ru_maxrss is in KB on Linux and bytes on macOS. This branch is mostly hit on macOS.
+    return {'rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024)}
+
+
+def load_handler(previous= None):
+    # prediction_model is imported here rather than at the top of api.py, so a worker can bind its port and answer
+    # /healthz before pandas and sklearn have been imported.
+    # On a reload 'previous' is the handler being replaced. Only the new matches are indexed if the tables grew.
+    start = time.perf_counter()
+    from prediction_model import ApiRequestHandler
+    import_seconds = time.perf_counter() - start
+
+    handler = ApiRequestHandler(previous=previous)
+    handler.startup_timings = {'import': import_seconds, **handler.startup_timings}
+    return handler
+
+
+def print_startup_report(handler):
+    report = ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in handler.startup_timings.items())
+    print(f"Worker {os.getpid()} startup: {report}")
+
+
+def print_worker_memory_report():
+    report = ", ".join(f"{key} {value:.1f}" for key, value in worker_memory_report().items())
+    print(f"Worker {os.getpid()} memory: {report or 'not available'}")
+
+
+def freeze_loaded_objects():
+    # Move everything loaded so far out of the GC's reach, so collections in the workers don't write to
+    # (and un-share) the pages holding it.
+    gc.collect()
+    gc.freeze()
+
+
+def start_workers(app: str, host: str, port: int, workers: int, sock: socket.socket) -> list[int]:
+    worker_pids = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            uvicorn.Server(uvicorn.Config(app, host=host, port=port)).run(sockets=[sock])
+            os._exit(0)
+        worker_pids.append(pid)
+    print(f"Started {workers} workers: {worker_pids}")
+    return worker_pids
+
+
+def stop_workers(worker_pids: list[int]):
+    # uvicorn's graceful shutdown: stop accepting, finish the requests in flight, then exit.
+    for pid in worker_pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+
+def reload_workers(app: str, host: str, port: int, workers: int, sock: socket.socket,
+                   worker_pids: list[int]) -> list[int]:
+    global preloaded_handler
+
+    reload_status.start()
+    try:
+        new_handler = load_handler(preloaded_handler)
+    except Exception as e:
+        # The old workers keep serving the old tables and model.
+        print(f"Reload failed: {e}")
+        reload_status.finish(error=str(e))
+        return worker_pids
+    print_startup_report(new_handler)
+
+    # The old handler is only referenced by the old workers from here on. Unfreeze so the parent's copy is freed.
+    gc.unfreeze()
+    preloaded_handler = new_handler
+    freeze_loaded_objects()
+    # Set before forking so the new workers start with the finished status.
+    reload_status.finish()
+    new_worker_pids = start_workers(app, host, port, workers, sock)
+    # Connections that arrive before the new workers accept wait in the shared socket's backlog, none are dropped.
+    stop_workers(worker_pids)
+    return new_worker_pids
+
+
+def serve(app: str, host: str, port: int, workers: int):
+    global preloaded_handler, parent_pid, reload_status
+
+    if workers <= 1 or not hasattr(os, 'fork'):
+        uvicorn.run(app, host=host, port=port)
+        return
+
+    preloaded_handler = load_handler()
+    print_startup_report(preloaded_handler)
+    parent_pid = os.getpid()
+    reload_status = ReloadStatus()
+    freeze_loaded_objects()
+
+    # One listening socket shared by all workers. The kernel spreads the connections between them.
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+
+    worker_pids = start_workers(app, host, port, workers, sock)
+    watcher, watch_interval = TablesWatcher.from_environment(preloaded_handler.tables_dir)
+    last_watch = time.monotonic()
+    signals = {"stop": False, "reload": False}
+
+    def request_stop(signum, frame):
+        signals["stop"] = True
+
+    def request_reload(signum, frame):
+        signals["reload"] = True
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGHUP, request_reload)
+    while not signals["stop"]:
+        time.sleep(0.2)
+        # Reap exited workers, old ones from earlier reloads included. Stop once none of the current ones is left.
+        try:
+            while True:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+                if pid == 0:
+                    break
+                if pid in worker_pids:
+                    worker_pids.remove(pid)
+        except ChildProcessError:
+            pass
+        if not worker_pids:
+            break
+
+        if watcher is not None and time.monotonic() - last_watch >= watch_interval:
+            last_watch = time.monotonic()
+            if watcher.changed():
+                print("Table files changed. Reloading.")
+                signals["reload"] = True
+        if signals["reload"]:
+            signals["reload"] = False
+            worker_pids = reload_workers(app, host, port, workers, sock, worker_pids)
+            if watcher is not None:
+                watcher.reset()
+
+    stop_workers(worker_pids)
+    try:
+        while True:
+            os.waitpid(-1, 0)
+    except ChildProcessError:
+        pass
+    sock.close()
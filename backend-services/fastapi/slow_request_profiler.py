@@ -0,0 +1,89 @@
+import os
+import re
+import sys
+import time
+import threading
+from collections import Counter, deque
+
+'''
+Opt-in sampling profiler for slow requests. Enabled by setting PROFILE_SLOW_REQUESTS_MS.
+
+A background thread samples the stack of every thread every PROFILE_INTERVAL_MS (default 5) and keeps the last few
+seconds of samples. When a request takes longer than the threshold, the samples taken on the threads and during the
+stages that handled it are written to PROFILE_DIR (default /tmp/atp-profiles) in the folded stack format that
+flamegraph.pl and speedscope read: one "frame;frame;frame count" line per distinct stack.
+'''
+
+
+class SlowRequestProfiler:
+    def __init__(self, threshold_ms: float, interval_ms: float = 5.0, output_dir: str = '/tmp/atp-profiles',
+                 history_seconds: float = 30.0):
+        self.threshold = threshold_ms / 1000
+        self.interval = interval_ms / 1000
+        self.output_dir = output_dir
+        # thread id -> (timestamp, folded stack) samples, oldest dropped first.
+        self.samples = {}
+        self.max_samples = int(history_seconds / self.interval)
+        self.lock = threading.Lock()
+        self.dumped = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample_loop, name='slow-request-profiler', daemon=True)
+
+    @classmethod
+    def from_environment(cls):
+        threshold_ms = os.environ.get("PROFILE_SLOW_REQUESTS_MS")
+        if not threshold_ms:
+            return None
+        return cls(float(threshold_ms), float(os.environ.get("PROFILE_INTERVAL_MS", 5)),
+                   os.environ.get("PROFILE_DIR", '/tmp/atp-profiles'))
+
+    def start(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def sample_loop(self):
+        own_id = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            now = time.perf_counter()
+            frames = sys._current_frames()
+            with self.lock:
+                for thread_id, frame in frames.items():
+                    if thread_id != own_id:
+                        self.samples.setdefault(thread_id, deque(maxlen=self.max_samples)).append(
+                            (now, self.fold(frame)))
+
+    @staticmethod
+    def fold(frame) -> str:
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+            frame = frame.f_back
+        return ';'.join(reversed(stack))
+
+    def is_slow(self, seconds: float) -> bool:
+        return seconds >= self.threshold
+
+    def dump(self, route: str, seconds: float, intervals: list[tuple[int, float, float]]):
+        # 'intervals' are (thread id, start, end) of the request's stages, from RequestTimings.
+        stacks = Counter()
+        with self.lock:
+            for thread_id, start, end in intervals:
+                for timestamp, stack in self.samples.get(thread_id, ()):
+                    if start <= timestamp <= end:
+                        stacks[stack] += 1
+        if not stacks:
+            return None
+
+        self.dumped += 1
+        route_name = re.sub(r'[^A-Za-z0-9]+', '_', route).strip('_') or 'root'
+        file_path = os.path.join(self.output_dir,
+                                 f'{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}-{self.dumped}-{route_name}'
+                                 f'-{seconds * 1000:.0f}ms.folded')
+        with open(file_path, 'w') as file:
+            for stack, count in stacks.most_common():
+                file.write(f'{stack} {count}\n')
+        return file_path
@@ -0,0 +1,22 @@
+'''
+Dtypes of the encoded tables. Shared by the writer (PrepareDataframe in scraper.py) and the reader
+(ModelOperations in prediction_model.py), so the two can't drift apart. Has no imports, so the scraper
+and the serving parent can import it without pulling in anything heavy.
+'''
+
+# Smallest dtypes that hold the encoded values, per table. Feather tables are written with these
+# and CSV tables are cast to them on load.
+TABLE_DTYPES = {
+    'model_df': {
+        'Player1': 'int32',
+        'Player2': 'int32',
+        'Target': 'int8',
+        'CourtSurface': 'int8',
+        'HeadToHead': 'int16',
+        'TotalWins_Player1': 'int32',
+        'TotalWins_Player2': 'int32',
+        'WinnerLoserHash': 'int64',
+    },
+    'player_index_df': {'Index': 'int32', 'TotalWins': 'int32'},
+    'court_surface_index_df': {'Index': 'int8'},
+}
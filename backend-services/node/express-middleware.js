@@ -10,10 +10,10 @@ app.use(express.json());
 
 app.use(cors({
     origin: '*',
-    methods: 'POST',
+    methods: 'GET,POST',
 }))
 
-app.post('*', async (req, res) => {
+const forwardRequest = async (req, res) => {
     const startTime = Date.now();
 
     try {
@@ -25,6 +25,7 @@ app.post('*', async (req, res) => {
             method:req.method, 
             url: `http://localhost:8080${req.path}`,
             data: req.body, 
+            params: req.query,
             headers: { "Content-Type": "application/json" }      
         });
 
@@ -35,7 +36,11 @@ app.post('*', async (req, res) => {
         logInvalidRequest(req, res, startTime);
         res.status(error.response.status).send(error.response.message);
     }
-});
+};
+
+app.post('*', forwardRequest);
+// Player name autocomplete is the only GET route exposed to the web client.
+app.get('/players/search', forwardRequest);
 
 app.options('*', cors())
 
@@ -4,13 +4,18 @@ const cache = new NodeCache()
 const RateLimitConfig = {
     maxRequests: 10,      
     expiration: 60,
+    // Autocomplete sends a request per keystroke, so it gets a higher limit.
+    endpointMaxRequests: {
+        '/players/search': 120,
+    },
 }
     
 async function checkLimit(clientKey, endpoint) {
     const key = `${clientKey}-${endpoint}`;
     let currentCount = cache.get(key) || 0;
+    const maxRequests = RateLimitConfig.endpointMaxRequests[endpoint] || RateLimitConfig.maxRequests;
 
-    if (currentCount > RateLimitConfig.maxRequests) {
+    if (currentCount > maxRequests) {
         throw new Error('Too many requests. Please wait before trying again.');
     }
 
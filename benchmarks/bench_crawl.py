@@ -0,0 +1,142 @@
+import os
+import io
+import sys
+import time
+import sqlite3
+import argparse
+import tempfile
+import threading
+import contextlib
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from scraper import TennisMatchScraper
+from benchmarks.synthetic_data import event_page
+
+'''
+Runs the scraper's crawl against a local HTTP server instead of flashscore, once on the main browser and once on a
+pool of browsers, and checks that both find the same results pages and store the same matches.
+
+The server serves a fixture site with the markup the scraper looks for: a start page with the ATP singles menu, an
+archive page per event and a results page per season (generated with synthetic_data.event_page). Saved flashscore
+pages can be served instead with --site, laid out the same way ('tennis/index.html',
+'tennis/atp-singles/<event>/archive/index.html', ...). --delay-ms adds a per-page delay to stand in for the network.
+
+Needs Chrome and a matching chromedriver. Run from the repository root:
+    python -m benchmarks.bench_crawl --events 6 --seasons 3 --workers 4 --delay-ms 200
+'''
+
+
+def write_page(site_dir: str, path: str, content: str):
+    page_dir = os.path.join(site_dir, path)
+    os.makedirs(page_dir, exist_ok=True)
+    with open(os.path.join(page_dir, 'index.html'), 'w', encoding='utf-8') as file:
+        file.write(content)
+
+
+def write_fixture_site(site_dir: str, events: int, seasons: int, matches_per_page: int):
+    menu = ''.join(f'<li><a href="/tennis/atp-singles/event-{event}/">Event {event}</a></li>' for event in range(events))
+    write_page(site_dir, 'tennis', f'<!DOCTYPE html><html><head><title>Tennis</title></head><body>'
+                                   f'<div id="lmenu_5724">ATP - Singles<ul>{menu}</ul></div></body></html>')
+
+    for event in range(events):
+        season_links = ''.join(
+            f'<div class="archive__season"><a class="archive__text archive__text--clickable" '
+            f'href="/tennis/atp-singles/event-{event}-{2023 - season}/">Event {event} {2023 - season}</a></div>'
+            for season in range(seasons))
+        write_page(site_dir, f'tennis/atp-singles/event-{event}/archive',
+                   f'<!DOCTYPE html><html><head><title>Event {event} archive</title></head><body>'
+                   f'<div id="fsbody">{season_links}</div></body></html>')
+        for season in range(seasons):
+            # A different seed per page keeps the match ids unique across the site.
+            write_page(site_dir, f'tennis/atp-singles/event-{event}-{2023 - season}/results',
+                       event_page(f'Event {event} {2023 - season}', matches_per_page, seed=event * seasons + season))
+
+
+class FixtureRequestHandler(SimpleHTTPRequestHandler):
+    delay = 0.0
+
+    def do_GET(self):
+        time.sleep(self.delay)
+        super().do_GET()
+
+    def log_message(self, format, *args):
+        pass
+
+
+@contextlib.contextmanager
+def fixture_server(site_dir: str, delay: float):
+    handler = type('DelayedFixtureRequestHandler', (FixtureRequestHandler,), {'delay': delay})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), partial(handler, directory=site_dir))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f'http://127.0.0.1:{server.server_address[1]}/tennis/'
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def crawl_site(start_url: str, workers: int, events: int, seasons: int) -> dict:
+    # Same steps as TennisMatchScraper.pipeline, without the prompts, storing into a fresh data.db.
+    with tempfile.TemporaryDirectory() as work_dir:
+        working_dir = os.getcwd()
+        os.chdir(work_dir)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                scraper = TennisMatchScraper(workers=workers, start_url=start_url, incremental=False)
+                try:
+                    archive_links = scraper.get_event_archive_links()
+                    result_links = scraper.get_link_list(archive_links, events, seasons)
+                    scraper.stream_matches(result_links)
+                finally:
+                    scraper.reset_main_driver()
+                elapsed = time.perf_counter() - start
+
+            db_connect = sqlite3.connect('data.db')
+            match_ids = sorted(row[0] for row in db_connect.execute("SELECT MatchID FROM MensATPSingles"))
+            crawled_links = sorted(row[0] for row in db_connect.execute("SELECT Url FROM CrawlState"))
+            db_connect.close()
+        finally:
+            os.chdir(working_dir)
+
+    return {'seconds': elapsed, 'result_links': sorted(result_links), 'crawled_links': crawled_links,
+            'match_ids': match_ids}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Crawl a local fixture site with one browser and with a pool.")
+    parser.add_argument('--site', help="Directory with saved pages to serve instead of the generated fixture site.")
+    parser.add_argument('--events', type=int, default=4)
+    parser.add_argument('--seasons', type=int, default=2)
+    parser.add_argument('--matches-per-page', type=int, default=30)
+    parser.add_argument('--workers', type=int, default=3)
+    parser.add_argument('--delay-ms', type=float, default=100, help="Delay before the server answers each page.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as site_dir:
+        if args.site:
+            site_dir = args.site
+        else:
+            write_fixture_site(site_dir, args.events, args.seasons, args.matches_per_page)
+
+        with fixture_server(site_dir, args.delay_ms / 1000) as start_url:
+            single = crawl_site(start_url, 1, args.events, args.seasons)
+            pooled = crawl_site(start_url, args.workers, args.events, args.seasons)
+
+    for key in ('result_links', 'crawled_links', 'match_ids'):
+        if single[key] != pooled[key]:
+            sys.exit(f"One browser and {args.workers} browsers crawled different {key.replace('_', ' ')}.")
+    if not single['match_ids']:
+        sys.exit("No matches were stored.")
+
+    print(f"Crawl check: {len(single['result_links'])} results pages, {len(single['match_ids'])} matches, "
+          f"same with 1 and {args.workers} browsers")
+    print(f"1 browser    {single['seconds']:8.2f}s")
+    print(f"{args.workers} browsers   {pooled['seconds']:8.2f}s  speedup {single['seconds'] / pooled['seconds']:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+import os
+import sys
+import time
+import hashlib
+import argparse
+import tempfile
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from scraper import PrepareDataframe
+from benchmarks.synthetic_data import write_database
+
+'''
+Times the PrepareDataframe encoding stages against the row-by-row versions they replaced,
+and checks that both produce the same output.
+
+Run from the repository root:
+    python -m benchmarks.bench_encoding --matches 100000 --players 2000
+'''
+
+
+# Previous implementations, kept here only as a reference for speed and output.
+def legacy_create_binary_target(df):
+    columns_drop = ['EventID', 'Player1Country', 'Player2Country', 'MatchDate', 'EventName']
+    sub_df = df.drop(columns=columns_drop)
+    sub_df['Target'] = 0
+    for index, row in df.iterrows():
+        if row['Winner'] == row['Player1']:
+            sub_df.at[index, 'Target'] = 1
+        elif row['Winner'] == row['Player2']:
+            sub_df.at[index, 'Target'] = 0
+    sub_df.drop(columns=['Winner', 'Loser'], inplace=True)
+
+    return sub_df
+
+
+def legacy_calc_total_wins(df, player_index_df):
+    player_index_df['TotalWins'] = 0
+    for index, row in player_index_df.iterrows():
+        player_index = row['Index']
+        wins_as_player1 = df.loc[(df['Player1'] == player_index) & (df['Target'] == 1), 'Target'].count()
+        player_index_df.loc[index, 'TotalWins'] += wins_as_player1
+    for index, row in player_index_df.iterrows():
+        player_index = row['Index']
+        wins_as_player2 = df.loc[(df['Player2'] == player_index) & (df['Target'] == 0), 'Target'].count()
+        player_index_df.loc[index, 'TotalWins'] += wins_as_player2
+
+    return player_index_df
+
+
+def legacy_calc_headtohead(df):
+    df['HeadToHead'] = 0
+    for index, row in df.iterrows():
+        player1_wins = (df[(df['Player1'] == row['Player1']) & (df['Player2'] == row['Player2'])][
+                            'Target'] == 1).sum()
+        df.at[index, 'HeadToHead'] = player1_wins - ((df[(df['Player1'] == row['Player2']) & (
+                df['Player2'] == row['Player1'])]['Target'] == 1).sum())
+
+    return df
+
+
+def legacy_matchup_hash(df):
+    df['WinnerLoserHash'] = 0
+    for index, row in df.iterrows():
+        hasher = hashlib.sha256()
+        player1 = str(row['Player1'])
+        player2 = str(row['Player2'])
+        combined_players = "#".join([player1, player2] if row['Target'] == 1 else [player2, player1])
+        hasher.update(combined_players.encode('utf-8'))
+        df.at[index, 'WinnerLoserHash'] = int(hasher.hexdigest()[:12], 16)
+
+    return df
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+
+    return result, time.perf_counter() - start
+
+
+def encode_players(df):
+    # Same index assignment as PrepareDataframe.create_player_index, without exporting anything.
+    unique_names = pd.concat([df['Player1'], df['Player2']], ignore_index=True).unique()
+    name_to_number = {name: i + 1 for i, name in enumerate(unique_names)}
+    df['Player1'] = df['Player1'].map(name_to_number)
+    df['Player2'] = df['Player2'].map(name_to_number)
+    player_index_df = pd.DataFrame({'Player': unique_names, 'Index': range(1, len(unique_names) + 1)})
+
+    return df, player_index_df
+
+
+def run_benchmark(matches: int, players: int, seed: int, headtohead_matches: int) -> list[dict]:
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        os.chdir(work_dir)
+        write_database('data.db', matches, players, seed)
+        prepare = PrepareDataframe()
+
+        legacy_target, legacy_time = timed(legacy_create_binary_target, prepare.df)
+        target, new_time = timed(prepare.create_binary_target, prepare.df)
+        pd.testing.assert_frame_equal(legacy_target, target)
+        results.append({'stage': 'create_binary_target', 'legacy_s': legacy_time, 'vectorized_s': new_time})
+
+        encoded_df, player_index_df = encode_players(target)
+        legacy_wins, legacy_time = timed(legacy_calc_total_wins, encoded_df, player_index_df.copy())
+        wins, new_time = timed(prepare.calc_total_wins, encoded_df, player_index_df.copy())
+        pd.testing.assert_frame_equal(legacy_wins, wins)
+        results.append({'stage': 'calc_total_wins', 'legacy_s': legacy_time, 'vectorized_s': new_time})
+
+        legacy_hashes, legacy_time = timed(legacy_matchup_hash, encoded_df.copy())
+        hashes, new_time = timed(prepare.matchup_hash, encoded_df.copy())
+        pd.testing.assert_frame_equal(legacy_hashes, hashes)
+        results.append({'stage': 'matchup_hash', 'legacy_s': legacy_time, 'vectorized_s': new_time})
+
+        # The legacy version scans the whole frame twice per row, so it only runs on the first matches.
+        headtohead_df = encoded_df.head(headtohead_matches)
+        legacy_headtohead, legacy_time = timed(legacy_calc_headtohead, headtohead_df.copy())
+        headtohead, new_time = timed(prepare.calc_headtohead, headtohead_df.copy())
+        pd.testing.assert_frame_equal(legacy_headtohead, headtohead)
+        results.append({'stage': 'calc_headtohead', 'legacy_s': legacy_time, 'vectorized_s': new_time})
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the PrepareDataframe encoding stages.")
+    parser.add_argument('--matches', type=int, default=100_000)
+    parser.add_argument('--players', type=int, default=2_000)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--headtohead-matches', type=int, default=10_000,
+                        help="Matches the calc_headtohead comparison runs on.")
+    args = parser.parse_args()
+
+    print(f"Encoding benchmark: {args.matches} matches, {args.players} players")
+    for result in run_benchmark(args.matches, args.players, args.seed, args.headtohead_matches):
+        speedup = result['legacy_s'] / result['vectorized_s']
+        print(f"{result['stage']:<22} legacy {result['legacy_s']:8.3f}s  "
+              f"vectorized {result['vectorized_s']:8.4f}s  speedup {speedup:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
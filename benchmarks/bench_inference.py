@@ -0,0 +1,165 @@
+import io
+import json
+import time
+import pickle
+import argparse
+import tempfile
+import contextlib
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.bench_stages import summarize, environment
+from benchmarks.synthetic_data import write_dataset
+from prediction_model import ModelOperations
+from flat_forest import FlatForest, HybridForest
+
+'''
+Compares the flat-array forest (flat_forest.py) with sklearn's RandomForestClassifier on a model trained on generated
+data: checks that both give identical probabilities and classes, then times single rows and batches and compares the
+memory taken by the trees. HybridForest (INFERENCE_ENGINE=hybrid) is timed too: it should follow the faster of the
+two. Then times anytime prediction (predict_proba_anytime) on single rows, for each --anytime-margins value: trees
+evaluated and how often the class matches the full forest.
+
+Rows are built like the API builds them: the TotalWins features are missing (NaN).
+
+Run from the repository root:
+    python -m benchmarks.bench_inference --matches 20000 --players 500 --output inference.json
+'''
+
+
+def api_rows(operations: ModelOperations, rows: int, seed: int) -> pd.DataFrame:
+    sample = operations.model_df.sample(rows, replace=True, random_state=seed)
+    return pd.DataFrame({
+        'Player1': sample['Player1'].to_numpy(),
+        'Player2': sample['Player2'].to_numpy(),
+        'HeadToHead': sample['HeadToHead'].to_numpy(),
+        'TotalWins_Player1': [None] * rows,
+        'TotalWins_Player2': [None] * rows,
+        'CourtSurface': sample['CourtSurface'].to_numpy(),
+    })[operations.feature_columns]
+
+
+def check_identical(model, flat_forest: FlatForest, rows: pd.DataFrame):
+    # With and without the missing TotalWins, so both branches of the traversal are covered.
+    with_totals = rows.assign(TotalWins_Player1=np.arange(len(rows)) % 50, TotalWins_Player2=np.arange(len(rows)) % 37)
+    for X in (rows, with_totals):
+        if not np.array_equal(model.predict_proba(X), flat_forest.predict_proba(X)):
+            raise AssertionError("Flat forest probabilities differ from sklearn.")
+        if not np.array_equal(model.predict(X), flat_forest.predict(X)):
+            raise AssertionError("Flat forest predictions differ from sklearn.")
+
+
+def time_batches(predict_proba, rows: pd.DataFrame, batch_size: int, calls: int) -> dict[str, float]:
+    samples = []
+    for i in range(calls):
+        start_row = (i * batch_size) % (len(rows) - batch_size + 1)
+        batch = rows.iloc[start_row:start_row + batch_size]
+        start = time.perf_counter()
+        predict_proba(batch)
+        samples.append(time.perf_counter() - start)
+
+    return summarize(samples)
+
+
+def time_anytime(flat_forest: FlatForest, rows: pd.DataFrame, min_margin: float, calls: int) -> dict:
+    full_classes = flat_forest.predict_proba(rows).argmax(axis=1)
+    samples = []
+    trees_used = []
+    stop_reasons = Counter()
+    agreeing = 0
+    for i in range(calls):
+        row = rows.iloc[i % len(rows):i % len(rows) + 1]
+        start = time.perf_counter()
+        probabilities, used, stop_reason = flat_forest.predict_proba_anytime(row, min_margin=min_margin)
+        samples.append(time.perf_counter() - start)
+        trees_used.append(used)
+        stop_reasons[stop_reason] += 1
+        agreeing += probabilities[0].argmax() == full_classes[i % len(rows)]
+
+    result = summarize(samples)
+    result.update(mean_trees=float(np.mean(trees_used)), agreement=agreeing / calls, stop_reasons=dict(stop_reasons))
+    return result
+
+
+def run_benchmark(args) -> dict:
+    report = {'config': vars(args).copy(), 'environment': environment(), 'results': {}}
+    with tempfile.TemporaryDirectory() as work_dir:
+        tables_dir = write_dataset(work_dir, args.matches, args.players, args.seed)
+        with contextlib.redirect_stdout(io.StringIO()):
+            operations = ModelOperations('csv', tables_dir)
+            start = time.perf_counter()
+            operations.train_model()
+            report['train_s'] = time.perf_counter() - start
+
+    model = operations.model
+    start = time.perf_counter()
+    flat_forest = FlatForest(model)
+    report['export_s'] = time.perf_counter() - start
+
+    rows = api_rows(operations, max(args.check_rows, max(args.batch_sizes) * 2), args.seed)
+    check_identical(model, flat_forest, rows)
+    hybrid_forest = HybridForest(model, args.max_flat_rows)
+    report['identical_rows_checked'] = len(rows) * 2
+
+    # sklearn's trees are pickled with their node arrays, so the pickle size is close to their memory.
+    report['memory_mb'] = {'sklearn': len(pickle.dumps(model)) / 1e6, 'flat': flat_forest.nbytes / 1e6}
+
+    for batch_size in args.batch_sizes:
+        report['results'][f'sklearn_batch_{batch_size}'] = time_batches(model.predict_proba, rows, batch_size,
+                                                                        args.calls)
+        report['results'][f'flat_batch_{batch_size}'] = time_batches(flat_forest.predict_proba, rows, batch_size,
+                                                                     args.calls)
+        report['results'][f'hybrid_batch_{batch_size}'] = time_batches(hybrid_forest.predict_proba, rows, batch_size,
+                                                                       args.calls)
+
+    for min_margin in args.anytime_margins:
+        report['results'][f'anytime_margin_{min_margin}'] = time_anytime(flat_forest, rows, min_margin, args.calls)
+
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the flat-array forest against sklearn.")
+    parser.add_argument('--matches', type=int, default=20_000)
+    parser.add_argument('--players', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--batch-sizes', default='1,2,32,256,1024', help="Comma separated rows per call.")
+    parser.add_argument('--calls', type=int, default=200)
+    parser.add_argument('--max-flat-rows', type=int, default=256, help="HybridForest's switch to sklearn.")
+    parser.add_argument('--check-rows', type=int, default=5000)
+    parser.add_argument('--anytime-margins', default='none,0.5,0.3',
+                        help="Comma separated min_margin values for anytime prediction, 'none' to only stop when decided.")
+    parser.add_argument('--output', help="Write the results to this JSON file.")
+    args = parser.parse_args()
+    args.batch_sizes = [int(size) for size in args.batch_sizes.split(',')]
+    args.anytime_margins = [None if margin == 'none' else float(margin) for margin in args.anytime_margins.split(',')]
+
+    print(f"Inference benchmark: model trained on {args.matches} matches, {args.players} players")
+    report = run_benchmark(args)
+    print(f"Identical predictions on {report['identical_rows_checked']} rows. "
+          f"Tree memory: sklearn {report['memory_mb']['sklearn']:.1f}MB, flat {report['memory_mb']['flat']:.1f}MB")
+    print(f"{'batch':>6}{'sklearn p50':>14}{'sklearn p99':>14}{'flat p50':>12}{'flat p99':>12}{'speedup':>10}"
+          f"{'hybrid p50':>14}")
+    for batch_size in args.batch_sizes:
+        sklearn_result = report['results'][f'sklearn_batch_{batch_size}']
+        flat_result = report['results'][f'flat_batch_{batch_size}']
+        hybrid_result = report['results'][f'hybrid_batch_{batch_size}']
+        print(f"{batch_size:>6}{sklearn_result['p50_s'] * 1000:>12.3f}ms{sklearn_result['p99_s'] * 1000:>12.3f}ms"
+              f"{flat_result['p50_s'] * 1000:>10.3f}ms{flat_result['p99_s'] * 1000:>10.3f}ms"
+              f"{sklearn_result['p50_s'] / flat_result['p50_s']:>9.1f}x{hybrid_result['p50_s'] * 1000:>12.3f}ms")
+    print(f"{'anytime margin':>15}{'p50':>12}{'p99':>12}{'mean trees':>12}{'agreement':>11}")
+    for min_margin in args.anytime_margins:
+        result = report['results'][f'anytime_margin_{min_margin}']
+        print(f"{str(min_margin):>15}{result['p50_s'] * 1000:>10.3f}ms{result['p99_s'] * 1000:>10.3f}ms"
+              f"{result['mean_trees']:>12.1f}{result['agreement']:>10.1%}")
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
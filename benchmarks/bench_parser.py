@@ -0,0 +1,74 @@
+import os
+import sys
+import glob
+import time
+import argparse
+import contextlib
+import io
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from scraper import EventPageParser
+from benchmarks.synthetic_data import event_page
+
+'''
+Compares the BeautifulSoup ('html.parser') and lxml paths of EventPageParser on event results pages,
+and checks that both return the same matches.
+
+Run from the repository root, with saved flashscore pages or with generated ones:
+    python -m benchmarks.bench_parser --pages path/to/saved_pages
+    python -m benchmarks.bench_parser --synthetic 50 --matches-per-page 60
+'''
+
+
+def load_pages(pages_dir: str) -> list[str]:
+    pages = []
+    for path in sorted(glob.glob(os.path.join(pages_dir, '*.html'))):
+        with open(path, encoding='utf-8') as file:
+            pages.append(file.read())
+
+    return pages
+
+
+def time_parser(parser: EventPageParser, pages: list[str], repeat: int) -> tuple[float, list]:
+    best = float('inf')
+    results = None
+    for _ in range(repeat):
+        # The parsers print skipped matches; keep that out of the report.
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            results = [parser.parse(page) for page in pages]
+            best = min(best, time.perf_counter() - start)
+
+    return best, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the event page parsers.")
+    parser.add_argument('--pages', help="Directory with saved event results pages (*.html).")
+    parser.add_argument('--synthetic', type=int, default=50, help="Number of generated pages if --pages is not set.")
+    parser.add_argument('--matches-per-page', type=int, default=60)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    if args.pages:
+        pages = load_pages(args.pages)
+    else:
+        pages = [event_page(f"ATP Benchmark Open {2010 + i % 15}", args.matches_per_page, seed=i)
+                 for i in range(args.synthetic)]
+    if not pages:
+        sys.exit("No pages to parse.")
+
+    soup_time, soup_results = time_parser(EventPageParser('html.parser'), pages, args.repeat)
+    lxml_time, lxml_results = time_parser(EventPageParser('lxml'), pages, args.repeat)
+    if soup_results != lxml_results:
+        sys.exit("Parsers returned different matches.")
+
+    matches = sum(len(result) for result in soup_results if result)
+    print(f"Parser benchmark: {len(pages)} pages, {matches} matches (best of {args.repeat})")
+    print(f"html.parser  {soup_time:8.3f}s  {soup_time / len(pages) * 1000:8.2f} ms/page")
+    print(f"lxml         {lxml_time:8.3f}s  {lxml_time / len(pages) * 1000:8.2f} ms/page  "
+          f"speedup {soup_time / lxml_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
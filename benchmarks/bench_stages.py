@@ -0,0 +1,269 @@
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import contextlib
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+API_DIR = os.path.join(REPO_DIR, 'backend-services', 'fastapi')
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, API_DIR)
+# Response caching would turn the repeated request stages into cache hits. Must be set before the handler is built.
+os.environ.setdefault('RESPONSE_CACHE_SIZE', '0')
+
+from scraper import DataCleanup, PrepareDataframe
+from prediction_model import ModelOperations, ApiRequestHandler
+from benchmarks.synthetic_data import write_database, write_dataset
+
+'''
+Benchmarks each stage of the pipeline and the API on generated data, and writes the results as JSON so runs can be
+compared. Pipeline stages (cleanup, encoding, table_load) are timed over whole runs, the request stages (lookup,
+headtohead, predict, stats, http) per call. Response caching is off unless RESPONSE_CACHE_SIZE is set.
+
+The request stages need a fitted model, so the first run on a dataset trains one (same settings as the API).
+
+Run from the repository root:
+    python -m benchmarks.bench_stages --matches 100000 --players 2000 --output results.json
+    python -m benchmarks.bench_stages --stages lookup,predict --baseline results.json
+'''
+
+STAGES = ['cleanup', 'encoding', 'table_load', 'lookup', 'headtohead', 'predict', 'stats', 'http']
+REQUEST_STAGES = ['lookup', 'headtohead', 'predict', 'stats', 'http']
+
+
+def summarize(samples: list[float]) -> dict[str, float]:
+    values = np.array(samples)
+    return {
+        'runs': len(samples),
+        'mean_s': float(values.mean()),
+        'p50_s': float(np.percentile(values, 50)),
+        'p99_s': float(np.percentile(values, 99)),
+        'min_s': float(values.min()),
+        'max_s': float(values.max()),
+    }
+
+
+def time_calls(function, calls: list[tuple]) -> dict[str, float]:
+    samples = []
+    for args in calls:
+        start = time.perf_counter()
+        function(*args)
+        samples.append(time.perf_counter() - start)
+
+    return summarize(samples)
+
+
+def bench_cleanup(work_dir: str, args) -> dict:
+    # DataCleanup changes the database in place, so every run starts from a fresh copy of the raw one.
+    stage_dir = os.path.join(work_dir, 'cleanup')
+    os.makedirs(stage_dir)
+    raw_db = os.path.join(stage_dir, 'raw.db')
+    write_database(raw_db, args.matches, args.players, args.seed, raw=True)
+    shutil.copy(os.path.join(REPO_DIR, 'event_courtsurfaces.csv'), stage_dir)
+
+    samples = []
+    os.chdir(stage_dir)
+    for _ in range(args.repeat):
+        for suffix in ['', '-wal', '-shm']:
+            if os.path.exists(f'data.db{suffix}'):
+                os.remove(f'data.db{suffix}')
+        shutil.copy(raw_db, 'data.db')
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            cleanup = DataCleanup(auto_run=True)
+            samples.append(time.perf_counter() - start)
+        del cleanup
+
+    return {'cleanup': summarize(samples)}
+
+
+def bench_encoding(work_dir: str, args) -> dict:
+    stage_dir = os.path.join(work_dir, 'encoding')
+    os.makedirs(stage_dir)
+    shutil.copy(os.path.join(work_dir, 'data', 'data.db'), stage_dir)
+
+    samples = []
+    os.chdir(stage_dir)
+    for _ in range(args.repeat):
+        # export_dataframe asks before overwriting, so every run starts without tables.
+        shutil.rmtree('backend-services', ignore_errors=True)
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            PrepareDataframe(auto_run=True, table_format=args.table_format)
+            samples.append(time.perf_counter() - start)
+
+    return {'encoding': summarize(samples)}
+
+
+def bench_table_load(work_dir: str, args) -> dict:
+    samples = []
+    phases = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        operations = ModelOperations(args.table_format, args.tables_dir)
+        samples.append(time.perf_counter() - start)
+        phases.append(operations.startup_timings)
+
+    # Mean time of each phase (reading the tables, building the indexes) next to the total.
+    result = summarize(samples)
+    result['phases_s'] = {phase: float(np.mean([run[phase] for run in phases])) for phase in phases[0]}
+
+    return {'table_load': result}
+
+
+def request_inputs(handler: ApiRequestHandler, args) -> list[tuple[str, str, str]]:
+    rng = np.random.default_rng(args.seed)
+    names = handler.player_index_df['Player'].to_numpy()
+    surfaces = list(handler.surface_index_by_name)
+    player1 = rng.integers(0, len(names), size=args.calls)
+    # Offset by 1..n-1 so a player never meets themselves.
+    player2 = (player1 + rng.integers(1, len(names), size=args.calls)) % len(names)
+    surface = rng.integers(0, len(surfaces), size=args.calls)
+
+    return [(names[a], names[b], surfaces[c]) for a, b, c in zip(player1, player2, surface)]
+
+
+def bench_lookup(handler: ApiRequestHandler, matchups: list[tuple], args) -> dict:
+    return {'lookup': time_calls(handler.player_index_lookup, [(player1,) for player1, _, _ in matchups])}
+
+
+def bench_headtohead(handler: ApiRequestHandler, matchups: list[tuple], args) -> dict:
+    indexes = [(handler.player_index_lookup(player1), handler.player_index_lookup(player2))
+               for player1, player2, _ in matchups]
+    return {'headtohead': time_calls(handler.calculate_headtohead, indexes)}
+
+
+def bench_predict(handler: ApiRequestHandler, matchups: list[tuple], args) -> dict:
+    # The full prediction path of the API (lookups, head-to-head, model call), without HTTP.
+    return {'predict': time_calls(handler.winner_prediction, matchups)}
+
+
+def bench_stats(handler: ApiRequestHandler, matchups: list[tuple], args) -> dict:
+    return {'stats': time_calls(handler.stats_lookup, [(player1,) for player1, _, _ in matchups])}
+
+
+def bench_http(handler: ApiRequestHandler, matchups: list[tuple], args) -> dict:
+    from fastapi.testclient import TestClient
+    import serving
+    import api
+
+    # The API uses this handler instead of loading the tables next to api.py.
+    serving.preloaded_handler = handler
+    try:
+        with contextlib.redirect_stdout(io.StringIO()), TestClient(api.app) as client:
+            def post(path: str, body: dict):
+                response = client.post(path, json=body)
+                response.raise_for_status()
+
+            predict_calls = [('/predict_winner', {'player1': player1, 'player2': player2, 'court_surface': surface})
+                             for player1, player2, surface in matchups]
+            stats_calls = [('/lookup_player_stats', {'player': player1}) for player1, _, _ in matchups]
+            return {'http_predict': time_calls(post, predict_calls), 'http_stats': time_calls(post, stats_calls)}
+    finally:
+        serving.preloaded_handler = None
+
+
+def environment() -> dict[str, str]:
+    import sklearn
+
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'sklearn': sklearn.__version__,
+    }
+
+
+def run_benchmark(args) -> dict:
+    report = {
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'config': {key: getattr(args, key) for key in ['matches', 'players', 'seed', 'table_format', 'repeat',
+                                                         'calls', 'stages']},
+        'environment': environment(),
+        'setup_s': {},
+        'results': {},
+    }
+    working_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as work_dir:
+        try:
+            start = time.perf_counter()
+            args.tables_dir = write_dataset(os.path.join(work_dir, 'data'), args.matches, args.players, args.seed,
+                                            args.table_format)
+            report['setup_s']['generate'] = time.perf_counter() - start
+
+            for stage, bench in [('cleanup', bench_cleanup), ('encoding', bench_encoding),
+                                 ('table_load', bench_table_load)]:
+                if stage in args.stages:
+                    report['results'].update(bench(work_dir, args))
+
+            request_stages = [stage for stage in REQUEST_STAGES if stage in args.stages]
+            if request_stages:
+                # Loading the handler trains the model on the generated tables the first time.
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    handler = ApiRequestHandler(args.table_format, args.tables_dir)
+                report['setup_s']['handler'] = time.perf_counter() - start
+                matchups = request_inputs(handler, args)
+                for stage in request_stages:
+                    report['results'].update(globals()[f'bench_{stage}'](handler, matchups, args))
+        finally:
+            os.chdir(working_dir)
+
+    return report
+
+
+def print_report(report: dict, baseline: dict = None):
+    print(f"{'stage':<14}{'p50':>12}{'p99':>12}{'mean':>12}{'runs':>8}" + (f"{'p50 vs baseline':>18}" if baseline else ''))
+    for name, result in report['results'].items():
+        line = (f"{name:<14}{result['p50_s'] * 1000:>10.4f}ms{result['p99_s'] * 1000:>10.4f}ms"
+                f"{result['mean_s'] * 1000:>10.4f}ms{result['runs']:>8}")
+        if baseline and name in baseline['results']:
+            line += f"{result['p50_s'] / baseline['results'][name]['p50_s']:>17.2f}x"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages and API on synthetic data.")
+    parser.add_argument('--matches', type=int, default=100_000)
+    parser.add_argument('--players', type=int, default=2_000)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--table-format', choices=['csv', 'feather'], default='csv')
+    parser.add_argument('--stages', default=','.join(STAGES), help=f"Comma separated, from: {', '.join(STAGES)}")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs of each pipeline stage.")
+    parser.add_argument('--calls', type=int, default=1000, help="Calls of each request stage.")
+    parser.add_argument('--output', help="Write the results to this JSON file.")
+    parser.add_argument('--baseline', help="JSON file from an earlier run to compare against.")
+    args = parser.parse_args()
+    args.stages = [stage.strip() for stage in args.stages.split(',')]
+    unknown = set(args.stages) - set(STAGES)
+    if unknown:
+        parser.error(f"Unknown stages: {', '.join(sorted(unknown))}")
+
+    print(f"Stage benchmark: {args.matches} matches, {args.players} players, {args.table_format} tables")
+    report = run_benchmark(args)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    print_report(report, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+import os
+import io
+import sys
+import shutil
+import sqlite3
+import argparse
+import contextlib
+from hashlib import sha256
+
+import numpy as np
+
+'''
+Seeded generator for fake ATP match data in the same format as 'data.db' after DataCleanup
+(or as scraped, before DataCleanup, with raw=True). Lets the pipeline stages be benchmarked without scraping anything.
+
+Run from the repository root to write data.db and the encoded tables/*.csv to a directory:
+    python -m benchmarks.synthetic_data --matches 100000 --players 2000 --output bench_data
+'''
+
+EVENTS = {
+    'Australian Open': 'Hard Court',
+    'French Open': 'Clay',
+    'Wimbledon': 'Grass',
+    'US Open': 'Hard Court',
+    'Indian Wells': 'Hard Court',
+    'Miami': 'Hard Court',
+    'Monte Carlo': 'Clay',
+    'Madrid': 'Clay',
+    'Rome': 'Clay',
+    'Halle': 'Grass',
+}
+
+
+def player_names(players: int) -> list[str]:
+    # "LastName F." like the scraped data.
+    return [f"Player{i} {chr(65 + i % 26)}." for i in range(players)]
+
+
+def generate_matches(matches: int, players: int, seed: int = 42, raw: bool = False) -> list[tuple]:
+    rng = np.random.default_rng(seed)
+    names = player_names(players)
+    event_names = list(EVENTS)
+
+    # Skewed so some players (and matchups) show up far more often than others, like the real tour.
+    weights = 1 / np.arange(1, players + 1) ** 0.8
+    weights /= weights.sum()
+    player1 = rng.choice(players, size=matches, p=weights)
+    player2 = rng.choice(players, size=matches, p=weights)
+    clash = player1 == player2
+    player2[clash] = (player2[clash] + 1) % players
+    player1_wins = rng.random(matches) < 0.5
+    events = rng.integers(0, len(event_names), size=matches)
+    # Raw data also has seasons before DataCleanup's 2010 cutoff, so the cleanup has rows to remove.
+    years = rng.integers(2005 if raw else 2010, 2025, size=matches)
+    months = rng.integers(1, 13, size=matches)
+    days = rng.integers(1, 29, size=matches)
+
+    rows = []
+    for i in range(matches):
+        event_name = event_names[events[i]]
+        event_id = f"ATP {event_name} {years[i]}"
+        match_date = f"{years[i]}-{days[i]:02d}.{months[i]:02d}. 12:00"
+        player_1 = names[player1[i]]
+        player_2 = names[player2[i]]
+        winner, loser = (player_1, player_2) if player1_wins[i] else (player_2, player_1)
+        match_id = sha256(f"{event_id}g_{i}{match_date}".encode()).hexdigest()
+        if raw:
+            # As scraped: no year in MatchDate, and EventName and CourtSurface are filled in by DataCleanup.
+            rows.append((event_id, match_id, match_date[5:], player_1, 'Country', player_2, 'Country',
+                         winner, loser, None, None))
+        else:
+            rows.append((event_id, match_id, match_date, player_1, 'Country', player_2, 'Country',
+                         winner, loser, event_name, EVENTS[event_name]))
+
+    return rows
+
+
+def write_database(db_path: str, matches: int, players: int, seed: int = 42, raw: bool = False):
+    db_connect = sqlite3.connect(db_path)
+    db_connect.execute("DROP TABLE IF EXISTS MensATPSingles")
+    db_connect.execute("""
+    CREATE TABLE MensATPSingles (
+    EventID TEXT,
+    MatchID TEXT PRIMARY KEY,
+    MatchDate TEXT,
+    Player1 TEXT,
+    Player1Country TEXT,
+    Player2 TEXT,
+    Player2Country TEXT,
+    Winner TEXT,
+    Loser TEXT,
+    EventName TEXT,
+    CourtSurface TEXT
+    )
+    """)
+    db_connect.executemany("INSERT INTO MensATPSingles VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                           generate_matches(matches, players, seed, raw))
+    db_connect.commit()
+    db_connect.close()
+
+
+def write_dataset(output_dir: str, matches: int, players: int, seed: int = 42, table_format: str = 'csv') -> str:
+    # Writes output_dir/data.db and encodes it with PrepareDataframe into output_dir/tables.
+    # Returns the tables directory, which ModelOperations can load with tables_dir=.
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+    from scraper import PrepareDataframe
+
+    output_dir = os.path.abspath(output_dir)
+    tables_dir = os.path.join(output_dir, 'tables')
+    os.makedirs(output_dir, exist_ok=True)
+    write_database(os.path.join(output_dir, 'data.db'), matches, players, seed)
+
+    # PrepareDataframe reads ./data.db and writes to ./backend-services/fastapi/tables.
+    working_dir = os.getcwd()
+    os.chdir(output_dir)
+    try:
+        shutil.rmtree('backend-services', ignore_errors=True)
+        with contextlib.redirect_stdout(io.StringIO()):
+            PrepareDataframe(auto_run=True, table_format=table_format)
+        shutil.rmtree(tables_dir, ignore_errors=True)
+        os.replace(os.path.join('backend-services', 'fastapi', 'tables'), tables_dir)
+        shutil.rmtree('backend-services')
+    finally:
+        os.chdir(working_dir)
+
+    return tables_dir
+
+
+def event_page(event_id: str, matches: int, seed: int = 42) -> str:
+    # Results page with the same markup the scraper reads from flashscore, plus some surrounding noise.
+    rng = np.random.default_rng(seed)
+    names = player_names(max(matches * 2, 2))
+    countries = ['Spain', 'Serbia', 'World', 'Italy', 'USA', 'France']
+    rows = []
+    for i in range(matches):
+        home_sets = int(rng.integers(0, 4))
+        away_sets = 3 - home_sets if home_sets != 3 else int(rng.integers(0, 3))
+        rows.append(
+            f'<div id="g_2_{seed}x{i}" class="event__match event__match--static event__match--twoLine" title="Click for match detail!">'
+            f'<div class="event__time">{int(rng.integers(1, 29)):02d}.{int(rng.integers(1, 13)):02d}. 12:00</div>'
+            f'<div class="event__participant event__participant--home fontBold">{names[2 * i]}</div>'
+            f'<span class="event__logo event__logo--home flag fl_1" title="{countries[i % len(countries)]}"></span>'
+            f'<div class="event__participant event__participant--away">{names[2 * i + 1]}</div>'
+            f'<span class="event__logo event__logo--away flag fl_2" title="{countries[(i + 3) % len(countries)]}"></span>'
+            f'<div class="event__score event__score--home">{home_sets}</div>'
+            f'<div class="event__score event__score--away">{away_sets}</div>'
+            + ''.join(f'<div class="event__part event__part--home event__part--{s}">6</div>'
+                      f'<div class="event__part event__part--away event__part--{s}">{int(rng.integers(0, 5))}</div>'
+                      for s in range(1, home_sets + away_sets + 1))
+            + '</div>')
+    menu = ''.join(f'<li><a href="/tennis/atp-singles/event-{i}/">Event {i}</a></li>' for i in range(200))
+
+    return (f'<!DOCTYPE html><html><head><title>{event_id}</title>'
+            f'<script>var cfg = {{"sport": "tennis"}};</script></head>'
+            f'<body><div id="lmenu"><ul>{menu}</ul></div><div id="fsbody"><div class="sportName tennis">'
+            f'<div class="event__header">{event_id}</div>{"".join(rows)}</div></div></body></html>')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a synthetic data.db and its encoded tables.")
+    parser.add_argument('--matches', type=int, default=100_000)
+    parser.add_argument('--players', type=int, default=2_000)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--table-format', choices=['csv', 'feather'], default='csv')
+    parser.add_argument('--output', default='bench_data')
+    args = parser.parse_args()
+
+    tables_dir = write_dataset(args.output, args.matches, args.players, args.seed, args.table_format)
+    print(f"Wrote {args.matches} matches between {args.players} players to {args.output}/data.db and {tables_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,34 @@
 import os
 import re
+import sys
+import json
+import time
+import queue
 import sqlite3
+import threading
 import hashlib
 from hashlib import sha256
+from typing import Optional
+from datetime import datetime
 
+import numpy as np
 import pandas as pd
 from bs4 import BeautifulSoup
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions
-from selenium.common.exceptions import TimeoutException, NoSuchElementException
+from selenium.common.exceptions import TimeoutException, NoSuchElementException, WebDriverException
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from lxml import html as lxml_html
+except ImportError:
+    lxml_html = None
+
+# The table dtypes are defined next to the API that reads the tables (backend-services/fastapi/table_schema.py).
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), 'backend-services', 'fastapi'))
+from table_schema import TABLE_DTYPES
 
 '''
 A web scraper to get tennis match data from www.flashscore.com and store it in an Sqlite database.
@@ -22,9 +40,12 @@ TennisScraper:
 Launches starting page with Selenium webdriver. 
 From there it goes through the whole event list (limit this for testing) and clicks through the archive list for each
 event to get to the match data. 
+With workers > 1 the archive and results pages are spread over a pool of headless browsers (BrowserPool).
 
 DataStorage:
 Collects the scraped data and stores it in a local Sqlite database. It will not overwrite an existing database, only add more matches to it.
+Schema changes are applied as numbered migrations on connect and recorded in the 'SchemaVersion' table.
+Scraped results pages are recorded in 'CrawlState' so completed seasons are not fetched again on the next run.
 Outputs: 'data.db'
 
 DataCleanup:
@@ -41,8 +62,96 @@ Final outputs: 'model_df.csv', 'player_index.csv', 'court_surface_index.csv'
 
 '''
 
+class ProgressCounter:
+    # Shared between worker threads, so increments are locked.
+    def __init__(self, label: str, total: int):
+        self.label = label
+        self.total = total
+        self.done = 0
+        self.lock = threading.Lock()
+
+    def increment(self):
+        with self.lock:
+            self.done += 1
+            print(f"{self.label}: {self.done}/{self.total}")
+
+
+class BrowserPool:
+    # Runs a task over a list of links on several headless browsers at once.
+    # Selenium drivers are not thread safe, so every worker thread launches and keeps its own.
+    def __init__(self, launch_browser, workers: int):
+        self.launch_browser = launch_browser
+        self.workers = workers
+        self.thread_local = threading.local()
+        self.drivers = []
+        self.drivers_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def worker_driver(self):
+        driver = getattr(self.thread_local, 'driver', None)
+        if driver is None:
+            driver = self.launch_browser()
+            self.thread_local.driver = driver
+            with self.drivers_lock:
+                self.drivers.append(driver)
+
+        return driver
+
+    def reset_worker_driver(self):
+        # Quits this worker's browser. The next worker_driver() call launches a new one.
+        driver = getattr(self.thread_local, 'driver', None)
+        if driver is None:
+            return
+        self.thread_local.driver = None
+        with self.drivers_lock:
+            self.drivers.remove(driver)
+        quit_driver(driver)
+
+    def map(self, task, links: list[str], progress: ProgressCounter) -> list:
+        # 'task(get_driver, reset_driver, link)' launches the worker's browser through get_driver(), so a browser
+        # that fails to start is retried with the task instead of failing the whole crawl. reset_driver() replaces
+        # a browser that has crashed.
+        def run_task(link):
+            result = task(self.worker_driver, self.reset_worker_driver, link)
+            progress.increment()
+            return result
+
+        # Results come back in the same order as 'links'.
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return list(executor.map(run_task, links))
+
+    def close(self):
+        for driver in self.drivers:
+            quit_driver(driver)
+        self.drivers = []
+
+
+def quit_driver(driver):
+    # A browser that has crashed can fail to quit. It's being dropped either way.
+    try:
+        driver.quit()
+    except WebDriverException as e:
+        print(f"Could not quit the browser: {e}")
+
+
 class TennisMatchScraper:
-    def __init__(self, auto_run= False):
+    SEASON_YEAR_REGEX = re.compile(r'-(\d{4})/results/?$')
+
+    def __init__(self, auto_run= False, workers= 1, retries= 3, backoff= 2.0,
+                 start_url= 'https://www.flashscore.com/tennis/', parser= 'lxml', incremental= True):
+        # 'start_url' can point at a local server with saved pages for testing.
+        self.start_url = start_url
+        # Skip results pages of completed seasons that are already in the database.
+        self.incremental = incremental
+        self.page_parser = EventPageParser(parser)
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
         self.driver = self.launch_browser()
 
         if auto_run:
@@ -52,16 +161,34 @@ class TennisMatchScraper:
         chrome_options = webdriver.ChromeOptions()
         chrome_options.add_argument("--headless")
         driver = webdriver.Chrome(options=chrome_options)
-        driver.get('https://www.flashscore.com/tennis/')
+        try:
+            driver.get(self.start_url)
+        except WebDriverException:
+            # Don't leave the browser running when a launch is retried.
+            driver.quit()
+            raise
 
         return driver
+
+    def main_driver(self):
+        # The browser used without a pool. Launched again after reset_main_driver().
+        if self.driver is None:
+            self.driver = self.launch_browser()
+
+        return self.driver
+
+    def reset_main_driver(self):
+        if self.driver is not None:
+            driver, self.driver = self.driver, None
+            quit_driver(driver)
     
     def pipeline(self):
         archive_it, years_it = self.set_scraper_scope()
         event_archive_links = self.get_event_archive_links()
         scraper_link_list = self.get_link_list(event_archive_links, archive_it, years_it)
-        all_source_code = self.get_source_code(scraper_link_list)
-        self.process_matches(all_source_code)
+        if self.incremental:
+            scraper_link_list = self.skip_ingested_links(scraper_link_list)
+        self.stream_matches(scraper_link_list)
     
     def set_scraper_scope(self):
         while True:
@@ -89,47 +216,91 @@ class TennisMatchScraper:
         return event_archive_links
 
     def get_link_list(self, event_archive_links: list[str], archive_it, years_it) -> list[str]:
+        def season_links(driver, link):
+            return self.season_result_links(driver, link, years_it)
+
+        link_lists = self.crawl(event_archive_links[:archive_it], season_links, "Archive pages")
+
+        return [link for link_list in link_lists if link_list for link in link_list]
+
+    def season_result_links(self, driver, link: str, years_it) -> list[str]:
         scraper_link_list = []
 
-        for link in event_archive_links[:archive_it]:
-            try:
-                self.driver.get(link)
-                WebDriverWait(self.driver, 10).until(
-                    expected_conditions.presence_of_element_located(
-                        (By.CSS_SELECTOR, "#fsbody .archive__season a.archive__text--clickable[href*='atp-singles/']")))
-                elements = self.driver.find_elements(By.CSS_SELECTOR,
-                                                     "#fsbody .archive__season a.archive__text--clickable[href*='atp-singles/']")
-                # Adjust number of iterations for how far back in time to scrape.
-                for element in elements[:years_it]:
-                    event_link = element.get_attribute('href')
-                    # Append 'results/' to get the right page.
-                    results_append = "results/"
-                    full_link = event_link + results_append
-                    scraper_link_list.append(full_link)
-
-            except TimeoutException:
-                print(f"TimeoutException occurred for link: {link}")
-            except Exception as e:
-                print(f"An error occurred for link {link}: {e}")
+        try:
+            driver.get(link)
+            WebDriverWait(driver, 10).until(
+                expected_conditions.presence_of_element_located(
+                    (By.CSS_SELECTOR, "#fsbody .archive__season a.archive__text--clickable[href*='atp-singles/']")))
+            elements = driver.find_elements(By.CSS_SELECTOR,
+                                            "#fsbody .archive__season a.archive__text--clickable[href*='atp-singles/']")
+            # Adjust number of iterations for how far back in time to scrape.
+            for element in elements[:years_it]:
+                event_link = element.get_attribute('href')
+                # Append 'results/' to get the right page.
+                results_append = "results/"
+                full_link = event_link + results_append
+                scraper_link_list.append(full_link)
+
+        except TimeoutException:
+            print(f"TimeoutException occurred for link: {link}")
+        except WebDriverException:
+            # Browser errors are retried by with_retries.
+            raise
+        except Exception as e:
+            # A malformed archive page only loses that event's seasons.
+            print(f"An error occurred for link {link}: {e}")
 
         return scraper_link_list
 
     def get_source_code(self, scraper_link_list: list[str]) -> list[str]:
         # List to store the source code for all events to be scraped.
-        all_source_code = []
+        all_source_code = self.crawl(scraper_link_list, self.event_source_code, "Results pages")
 
-        for link in scraper_link_list:
-            self.driver.get(link)
-            # Some events are empty, so we need to check for 'event__match' to make sure there's data to scrape.
-            try:
-                WebDriverWait(self.driver, 5).until(
-                    expected_conditions.visibility_of_element_located((By.CLASS_NAME, 'event__match')))
-            except TimeoutException:
-                print(f"Unable to find 'event__match' element for link {link}. Skipping.")
-                continue
-            all_source_code.append(self.driver.page_source)
+        return [source_code for source_code in all_source_code if source_code]
+
+    def event_source_code(self, driver, link: str) -> Optional[str]:
+        driver.get(link)
+        # Some events are empty, so we need to check for 'event__match' to make sure there's data to scrape.
+        try:
+            WebDriverWait(driver, 5).until(
+                expected_conditions.visibility_of_element_located((By.CLASS_NAME, 'event__match')))
+        except TimeoutException:
+            print(f"Unable to find 'event__match' element for link {link}. Skipping.")
+            return None
+
+        return driver.page_source
+
+    def crawl(self, links: list[str], task, label: str) -> list:
+        # Runs 'task(driver, link)' for every link, on the main browser or spread over a pool of browsers.
+        progress = ProgressCounter(label, len(links))
+
+        def task_with_retries(get_driver, reset_driver, link):
+            return self.with_retries(task, get_driver, reset_driver, link)
 
-        return all_source_code
+        if self.workers <= 1:
+            results = []
+            for link in links:
+                results.append(task_with_retries(self.main_driver, self.reset_main_driver, link))
+                progress.increment()
+            return results
+
+        with BrowserPool(self.launch_browser, self.workers) as pool:
+            return pool.map(task_with_retries, links, progress)
+
+    def with_retries(self, task, get_driver, reset_driver, link: str):
+        # Browser/network errors, including a browser that fails to launch, are retried with exponential backoff.
+        # Timeouts waiting for content are handled by the tasks themselves since they usually mean the page has
+        # no data.
+        for attempt in range(self.retries + 1):
+            try:
+                return task(get_driver(), link)
+            except WebDriverException as e:
+                # The browser may have crashed, so the next attempt (or link) starts on a new one.
+                reset_driver()
+                if attempt == self.retries:
+                    print(f"An error occurred for link {link}: {e}")
+                    return None
+                time.sleep(self.backoff * 2 ** attempt)
     
     def process_matches(self, all_source_code: list[str]):
         database = DataStorage()
@@ -140,6 +311,100 @@ class TennisMatchScraper:
             if event_matches:
                 database.append_data(db_connect, event_matches)
 
+    def skip_ingested_links(self, scraper_link_list: list[str]) -> list[str]:
+        database = DataStorage()
+        db_connect = database.database_connect()
+        ingested_links = database.ingested_links(db_connect)
+        db_connect.close()
+
+        current_year = datetime.now().year
+        links_to_fetch = []
+        for link in scraper_link_list:
+            # Archive links carry the season year (e.g. '.../australian-open-2023/results/'). The current season
+            # has none, and it is the only one that can still get new matches, so it is always fetched.
+            season = self.SEASON_YEAR_REGEX.search(link)
+            season_completed = season is not None and int(season.group(1)) < current_year
+            if season_completed and link in ingested_links:
+                continue
+            links_to_fetch.append(link)
+
+        print(f"Skipping {len(scraper_link_list) - len(links_to_fetch)} already ingested results pages.")
+        return links_to_fetch
+
+    def stream_matches(self, scraper_link_list: list[str], queue_size= 8):
+        # Fetch -> parse -> store, each on its own thread(s) and connected by bounded queues.
+        # Every page is dropped once its matches are stored, so memory stays flat and a crash only loses
+        # the pages in flight. Fetchers block when the queues are full (backpressure).
+        page_queue = queue.Queue(maxsize=queue_size)
+        match_queue = queue.Queue(maxsize=queue_size)
+        # Set by the storer when it can't open the database. The remaining pages are then not fetched.
+        storage_failed = threading.Event()
+
+        def fetch_page(driver, link):
+            if storage_failed.is_set():
+                return
+            source_code = self.event_source_code(driver, link)
+            if source_code:
+                page_queue.put((link, source_code))
+
+        parser = threading.Thread(target=self.parse_pages, args=(page_queue, match_queue))
+        storer = threading.Thread(target=self.store_matches, args=(match_queue, storage_failed))
+        parser.start()
+        storer.start()
+        try:
+            self.crawl(scraper_link_list, fetch_page, "Results pages")
+        finally:
+            # None marks the end of the stream for the parser, which passes it on to the storer.
+            page_queue.put(None)
+            parser.join()
+            storer.join()
+        if storage_failed.is_set():
+            raise RuntimeError("Could not open the database. No matches were stored.")
+
+    def parse_pages(self, page_queue: queue.Queue, match_queue: queue.Queue):
+        while True:
+            page = page_queue.get()
+            if page is None:
+                match_queue.put(None)
+                break
+            link, event_source_code = page
+            # A bad page must not stop the consumer, or the fetchers would block on a full queue forever.
+            try:
+                event_matches = self.scraper(event_source_code)
+            except Exception as e:
+                print(f"Error parsing event page: {e}")
+                continue
+            match_queue.put((link, event_matches or []))
+
+    def store_matches(self, match_queue: queue.Queue, storage_failed: threading.Event):
+        # SQLite connections can't be shared between threads, so the storer opens its own.
+        database = DataStorage()
+        db_connect = database.database_connect()
+        if db_connect is None:
+            # Stop the fetchers, then keep draining the queue until the end marker so nothing upstream blocks.
+            storage_failed.set()
+            while match_queue.get() is not None:
+                pass
+            return
+        total_inserted = 0
+        total_skipped = 0
+        while True:
+            parsed_page = match_queue.get()
+            if parsed_page is None:
+                break
+            link, event_matches = parsed_page
+            try:
+                if event_matches:
+                    inserted, skipped = database.append_data(db_connect, event_matches)
+                    total_inserted += inserted
+                    total_skipped += skipped
+                database.record_crawl(db_connect, link, len(event_matches))
+            # Like the parser, the storer must keep consuming after a bad page or the pipeline stalls.
+            except Exception as e:
+                print(f"Error storing event matches for {link}: {e}")
+        db_connect.close()
+        print(f"Stored {total_inserted} new matches ({total_skipped} already in the database).")
+
     # Does not work yet.
     def click_more_matches(self):
         try:
@@ -150,6 +415,26 @@ class TennisMatchScraper:
             print(f'No clickable element for {element}')
 
     def scraper(self, event_source_code: str) -> list[dict[str, str]]:
+        return self.page_parser.parse(event_source_code)
+
+
+class EventPageParser:
+    # Extracts the match rows from an event results page.
+    # 'lxml': parses with lxml and collects all fields of a match row in one pass over its elements.
+    # 'html.parser': the original BeautifulSoup path. Both return the same list of match dicts.
+    def __init__(self, parser= 'lxml'):
+        if parser == 'lxml' and lxml_html is None:
+            print("lxml is not installed. Falling back to 'html.parser'.")
+            parser = 'html.parser'
+        self.parser = parser
+
+    def parse(self, event_source_code: str) -> list[dict[str, str]]:
+        if self.parser == 'lxml':
+            return self.parse_lxml(event_source_code)
+
+        return self.parse_soup(event_source_code)
+
+    def parse_soup(self, event_source_code: str) -> list[dict[str, str]]:
         soup = BeautifulSoup(event_source_code, 'html.parser')
         match_div = soup.find('div', class_='event__match')
         event_id = soup.find('title').text
@@ -162,71 +447,104 @@ class TennisMatchScraper:
 
             for match in matches:
                 try:
-                    # MatchID and MatchDate
-                    match_id = match['id']
-                    match_date = match.find('div', class_='event__time').text
-
-                    # Player1
-                    player_1 = match.find('div', class_='event__participant--home').text
-                    flag_player_1 = match.find('span', class_='event__logo--home')
-                    player_1_country = flag_player_1.get('title')
-                    # Country has to be changed for political reasons:
-                    if player_1_country == 'World':
-                        player_1_country = 'Russia'
-
-                    # Player2
-                    player_2 = match.find('div', class_='event__participant--away').text
-                    flag_player_2 = match.find('span', class_='event__logo--away')
-                    player_2_country = flag_player_2.get('title')
-                    if player_2_country == 'World':
-                        player_2_country = 'Russia'
-
-                    # Collect won sets to determine winner.
-                    player_1_sets = int(match.find('div', class_='event__score--home').text)
-                    player_2_sets = int(match.find('div', class_='event__score--away').text)
-
-                    if player_1_sets > player_2_sets:
-                        winner = player_1
-                        loser = player_2
-                    else:
-                        winner = player_2
-                        loser = player_1
-
-                    # Dict. to store unique values for each match.
-                    event_matches.append({'event_id': event_id, 'match_id': match_id, 'match_date': match_date,
-                                          'player_1': player_1, 'player_1_country': player_1_country,
-                                          'player_2': player_2, 'player_2_country': player_2_country,
-                                          'winner': winner, 'loser': loser})
+                    event_matches.append(self.match_data(
+                        event_id, match['id'],
+                        match.find('div', class_='event__time').text,
+                        match.find('div', class_='event__participant--home').text,
+                        match.find('span', class_='event__logo--home').get('title'),
+                        match.find('div', class_='event__participant--away').text,
+                        match.find('span', class_='event__logo--away').get('title'),
+                        match.find('div', class_='event__score--home').text,
+                        match.find('div', class_='event__score--away').text))
                 except Exception as e:
                     print(f"Error processing match: {e}")
                     continue
-            else:
-                print("Match element not found")
 
             return event_matches
+        else:
+            print("Match element not found")
+
+    # Element tag for each field class, as looked up in parse_soup.
+    MATCH_FIELDS = {
+        'event__time': 'div',
+        'event__participant--home': 'div',
+        'event__logo--home': 'span',
+        'event__participant--away': 'div',
+        'event__logo--away': 'span',
+        'event__score--home': 'div',
+        'event__score--away': 'div',
+    }
+
+    def parse_lxml(self, event_source_code: str) -> list[dict[str, str]]:
+        tree = lxml_html.fromstring(event_source_code)
+        event_id = tree.find('.//title').text_content()
+        matches = tree.xpath('//div[contains(concat(" ", normalize-space(@class), " "), " event__match ")]')
+
+        if matches and matches[0].get('id', '').startswith('g_'):
+            event_matches = []
+
+            for match in matches:
+                try:
+                    # One walk over the row. The first element carrying each field class wins, like find().
+                    fields = {}
+                    for element in match.iterdescendants():
+                        for css_class in element.get('class', '').split():
+                            if self.MATCH_FIELDS.get(css_class) == element.tag and css_class not in fields:
+                                fields[css_class] = element
+
+                    event_matches.append(self.match_data(
+                        event_id, match.attrib['id'],
+                        fields['event__time'].text_content(),
+                        fields['event__participant--home'].text_content(),
+                        fields['event__logo--home'].get('title'),
+                        fields['event__participant--away'].text_content(),
+                        fields['event__logo--away'].get('title'),
+                        fields['event__score--home'].text_content(),
+                        fields['event__score--away'].text_content()))
+                except Exception as e:
+                    print(f"Error processing match: {e}")
+                    continue
+
+            return event_matches
+        else:
+            print("Match element not found")
+
+    def match_data(self, event_id: str, match_id: str, match_date: str, player_1: str, player_1_country: str,
+                   player_2: str, player_2_country: str, player_1_sets: str, player_2_sets: str) -> dict[str, str]:
+        # Country has to be changed for political reasons:
+        if player_1_country == 'World':
+            player_1_country = 'Russia'
+        if player_2_country == 'World':
+            player_2_country = 'Russia'
+
+        # Collect won sets to determine winner.
+        if int(player_1_sets) > int(player_2_sets):
+            winner = player_1
+            loser = player_2
+        else:
+            winner = player_2
+            loser = player_1
+
+        # Dict. to store unique values for each match.
+        return {'event_id': event_id, 'match_id': match_id, 'match_date': match_date,
+                'player_1': player_1, 'player_1_country': player_1_country,
+                'player_2': player_2, 'player_2_country': player_2_country,
+                'winner': winner, 'loser': loser}
 
 
 class DataStorage():
-    def database_connect(self):
+    def database_connect(self, db_path= "data.db"):
         try:
             # Establish connection to database and create a new one if none exists.
-            db_path = "data.db"
             db_connect = sqlite3.connect(db_path)
-            create_table_query = """
-            CREATE TABLE IF NOT EXISTS MensATPSingles (
-            EventID TEXT,
-            MatchID TEXT PRIMARY KEY,
-            MatchDate TEXT, 
-            Player1 TEXT,
-            Player1Country TEXT,
-            Player2 TEXT, 
-            Player2Country TEXT,
-            Winner TEXT,
-            Loser TEXT
-            )
-            """
-            db_connect.execute(create_table_query)
-            db_connect.commit()
+            # WAL lets the cleanup/encoding steps read while the scraper writes. NORMAL sync is safe with WAL
+            # and avoids an fsync per commit.
+            db_connect.execute("PRAGMA journal_mode = WAL")
+            db_connect.execute("PRAGMA synchronous = NORMAL")
+            db_connect.execute("PRAGMA temp_store = MEMORY")
+            db_connect.execute("PRAGMA cache_size = -64000")
+            db_connect.execute("PRAGMA busy_timeout = 5000")
+            self.migrate(db_connect)
 
             return db_connect
 
@@ -235,24 +553,107 @@ class DataStorage():
 
             return None
 
-    def append_data(self, dbconnect, event_matches: list[dict[str, str]]):
-        cursor = dbconnect.cursor()
-        insert_query = ("INSERT INTO MensATPSingles (EventID, MatchID, MatchDate, Player1, Player1Country, Player2, "
-                        "Player2Country, Winner, Loser) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)")
+    def migrations(self):
+        # Schema changes in the order they were introduced. Add new ones at the end, never edit old ones.
+        return [
+            (1, self.create_matches_table),
+            (2, self.add_cleanup_columns),
+            (3, self.create_indexes),
+            (4, self.create_crawl_state_table),
+        ]
+
+    def migrate(self, db_connect):
+        # sqlite3 only opens a transaction by itself before INSERT/UPDATE/DELETE, so CREATE and ALTER would be
+        # committed on their own. Its transaction handling is turned off here and each migration runs in an explicit
+        # transaction, so a crash can't leave a migration applied but not recorded.
+        isolation_level = db_connect.isolation_level
+        db_connect.isolation_level = None
+        try:
+            db_connect.execute("CREATE TABLE IF NOT EXISTS SchemaVersion (Version INTEGER PRIMARY KEY, AppliedAt TEXT)")
+            current_version = db_connect.execute("SELECT MAX(Version) FROM SchemaVersion").fetchone()[0] or 0
+
+            for version, migration in self.migrations():
+                if version <= current_version:
+                    continue
+                # IMMEDIATE takes the write lock up front. Checked again under the lock, in case another process
+                # applied the migration since the version was read.
+                db_connect.execute("BEGIN IMMEDIATE")
+                try:
+                    if db_connect.execute("SELECT 1 FROM SchemaVersion WHERE Version = ?", (version,)).fetchone() is None:
+                        migration(db_connect)
+                        db_connect.execute("INSERT INTO SchemaVersion (Version, AppliedAt) VALUES (?, datetime('now'))",
+                                           (version,))
+                except BaseException:
+                    db_connect.execute("ROLLBACK")
+                    raise
+                db_connect.execute("COMMIT")
+        finally:
+            db_connect.isolation_level = isolation_level
+
+    def create_matches_table(self, db_connect):
+        create_table_query = """
+        CREATE TABLE IF NOT EXISTS MensATPSingles (
+        EventID TEXT,
+        MatchID TEXT PRIMARY KEY,
+        MatchDate TEXT, 
+        Player1 TEXT,
+        Player1Country TEXT,
+        Player2 TEXT, 
+        Player2Country TEXT,
+        Winner TEXT,
+        Loser TEXT
+        )
+        """
+        db_connect.execute(create_table_query)
+
+    def add_cleanup_columns(self, db_connect):
+        # Filled in by DataCleanup. Databases from before migrations may already have them.
+        columns = [column[1] for column in db_connect.execute("PRAGMA table_info(MensATPSingles)")]
+        for column in ['EventName', 'CourtSurface']:
+            if column not in columns:
+                db_connect.execute(f"ALTER TABLE MensATPSingles ADD COLUMN {column} TEXT")
+
+    def create_indexes(self, db_connect):
+        for column in ['EventID', 'EventName', 'MatchDate', 'Player1', 'Player2']:
+            db_connect.execute(f"CREATE INDEX IF NOT EXISTS idx_MensATPSingles_{column} ON MensATPSingles ({column})")
+
+    def create_crawl_state_table(self, db_connect):
+        # One row per results page that has been scraped, so later runs can skip it.
+        db_connect.execute("""
+        CREATE TABLE IF NOT EXISTS CrawlState (
+        Url TEXT PRIMARY KEY,
+        FetchedAt TEXT,
+        MatchCount INTEGER
+        )
+        """)
+
+    def record_crawl(self, dbconnect, url: str, match_count: int):
+        with dbconnect:
+            dbconnect.execute("INSERT OR REPLACE INTO CrawlState (Url, FetchedAt, MatchCount) "
+                              "VALUES (?, datetime('now'), ?)", (url, match_count))
+
+    def ingested_links(self, dbconnect) -> set[str]:
+        # Pages that gave no matches are not counted as ingested, so they are tried again.
+        return {row[0] for row in dbconnect.execute("SELECT Url FROM CrawlState WHERE MatchCount > 0")}
+
+    def append_data(self, dbconnect, event_matches: list[dict[str, str]]) -> tuple[int, int]:
+        insert_query = ("INSERT OR IGNORE INTO MensATPSingles (EventID, MatchID, MatchDate, Player1, Player1Country, "
+                        "Player2, Player2Country, Winner, Loser) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)")
         # Append scraped data to the database.
         # Insert query must follow the order specified in template above.
-        for data in event_matches:
-            try:
-                # MatchID are reused over different events, so we have to create a unique PRIMARY KEY for each match.
-                match_hash = self.create_match_id(data)
-                cursor.execute(insert_query,
-                               (data['event_id'], match_hash, data['match_date'], data['player_1'],
-                                data['player_1_country'], data['player_2'], data['player_2_country'],
-                                data['winner'], data['loser']))
-            except sqlite3.IntegrityError:
-                print(f"MatchID: {data['match_id']} already exists. Skipping to next entry.")
-                continue
-        dbconnect.commit()
+        # MatchID are reused over different events, so we have to create a unique PRIMARY KEY for each match.
+        rows = [(data['event_id'], self.create_match_id(data), data['match_date'], data['player_1'],
+                 data['player_1_country'], data['player_2'], data['player_2_country'], data['winner'], data['loser'])
+                for data in event_matches]
+        # Matches that already exist are skipped by 'OR IGNORE', so rowcount is the number actually inserted.
+        with dbconnect:
+            cursor = dbconnect.executemany(insert_query, rows)
+        inserted = cursor.rowcount
+        skipped = len(rows) - inserted
+        if skipped:
+            print(f"{skipped} matches already exist. Skipped.")
+
+        return inserted, skipped
 
     def create_match_id(self, data: dict[str, str]) -> str:
         hasher = sha256()
@@ -264,10 +665,13 @@ class DataStorage():
 
 class DataCleanup():
     def __init__(self, auto_run= False, year_cutoff= 2010):
-        self.conn = sqlite3.connect('data.db')
+        # Connecting through DataStorage applies any pending schema migrations (e.g. the EventName column).
+        self.conn = DataStorage().database_connect()
         self.cursor = self.conn.cursor()
         self.YYYYMMDD_REGEX = re.compile(r'^\d{4}-\d{2}.\d{2}')
         self.YYYY_REGEX = re.compile(r'\d{4}')
+        self.EVENT_NAME_REGEX = re.compile(r'ATP\s(.+?)\s\d{4}')
+        self.register_sql_functions()
 
         if auto_run:
             self.pipeline(year_cutoff)
@@ -275,120 +679,72 @@ class DataCleanup():
     def __del__(self):
         self.conn.close()
 
-    def pipeline(self, year_cutoff):
-        self.append_year_to_match_date()
-        self.delete_where_no_year()
-        self.remove_before_year(year_cutoff)
-        self.create_tournament_table()
-        self.append_court_surface()
-
-    def append_year_to_match_date(self):
-        self.cursor.execute("SELECT EventID, MatchID, MatchDate FROM MensATPSingles")
-        rows = self.cursor.fetchall()
-        update_table_query = "UPDATE MensATPSingles SET MatchDate = ? WHERE MatchID = ?"
+    def register_sql_functions(self):
+        # The regex checks run inside SQLite so every step can be a single set-based statement
+        # instead of fetching all rows into Python and writing them back one by one.
+        self.conn.create_function('has_year', 1, self.has_year, deterministic=True)
+        self.conn.create_function('event_year', 1, self.event_year, deterministic=True)
+        self.conn.create_function('event_name', 1, self.event_name, deterministic=True)
 
-        # List to store new MatchDate with corresponding MatchID.
-        # I tried doing the updating within the loop but the program took minutes to run. This is more efficient.
-        data_to_update = []
+    def has_year(self, match_date: str) -> bool:
+        # Check if MatchDate already has the correct format.
+        return bool(self.YYYYMMDD_REGEX.match(match_date))
 
-        for row in rows:
-            event_id = row[0]
-            match_id = row[1]
-            match_date = row[2]
+    def event_year(self, event_id: str) -> Optional[str]:
+        match = self.YYYY_REGEX.search(event_id)
+        return match.group() if match else None
 
-            if self.YYYYMMDD_REGEX.match(match_date):
-                continue
+    def event_name(self, event_id: str) -> Optional[str]:
+        match = self.EVENT_NAME_REGEX.search(event_id)
+        return match.group(1) if match else None
 
-            match = self.YYYY_REGEX.search(event_id)
-            if match:
-                year = int(match.group())
-                new_match_date = f"{year}-{match_date}"
-                data_to_update.append((new_match_date, match_id))
-            else:
-                continue
+    def pipeline(self, year_cutoff):
+        # All steps run in one transaction, so the cleanup is either applied completely or not at all.
+        with self.conn:
+            self.append_year_to_match_date()
+            self.delete_where_no_year()
+            self.remove_before_year(year_cutoff)
+            self.create_tournament_table()
+            self.append_court_surface()
 
-        if data_to_update:
-            self.cursor.executemany(update_table_query, data_to_update)
-        self.conn.commit()
+    def append_year_to_match_date(self):
+        # MatchDate is missing the year, so it is taken from EventID where there is one.
+        self.cursor.execute("""UPDATE MensATPSingles SET MatchDate = event_year(EventID) || '-' || MatchDate
+                               WHERE NOT has_year(MatchDate) AND event_year(EventID) IS NOT NULL""")
 
     def delete_where_no_year(self):
-        self.cursor.execute("SELECT EventID, MatchDate FROM MensATPSingles")
-        rows = self.cursor.fetchall()
-
-        for row in rows:
-            event_id = row[0]
-            match_date = row[1]
-            # Check if MatchDate already has the correct format.
-            if self.YYYYMMDD_REGEX.match(match_date):
-                continue
-
-            match = self.YYYY_REGEX.search(event_id)
-
-            if not match:
-                self.cursor.execute("DELETE FROM MensATPSingles WHERE EventID = ?", (event_id,))
-                continue
-
-        self.conn.commit()
+        # Events with a row that has no year anywhere can't be dated, so the whole event is removed.
+        self.cursor.execute("""DELETE FROM MensATPSingles WHERE EventID IN (
+                               SELECT EventID FROM MensATPSingles
+                               WHERE NOT has_year(MatchDate) AND event_year(EventID) IS NULL)""")
 
     def remove_before_year(self, year: int):
-        self.cursor.execute("SELECT MatchID, MatchDate FROM MensATPSingles")
-        rows = self.cursor.fetchall()
-
-        for row in rows:
-            match_id = row[0]
-            match_date = row[1]
-            if int(match_date[:4]) < year:  # First 4 digits is the year.
-                self.cursor.execute("DELETE FROM MensATPSingles WHERE MatchID = ?", (match_id,))
-        self.conn.commit()
+        # First 4 digits is the year.
+        self.cursor.execute("DELETE FROM MensATPSingles WHERE CAST(substr(MatchDate, 1, 4) AS INTEGER) < ?",
+                            (year,))
 
     def create_tournament_table(self):
-        self.cursor.execute("PRAGMA table_info(MensATPSingles)")
-        columns = self.cursor.fetchall()
-        # Returns TRUE if any column = 'EventName'
-        event_name_column_exists = any(column[1] == 'EventName' for column in columns)
-        if not event_name_column_exists:
-            self.cursor.execute('''ALTER TABLE MensATPSingles
-                                        ADD COLUMN EventName TEXT''')
-
-        self.cursor.execute("SELECT EventID FROM MensATPSingles")
-        rows = self.cursor.fetchall()
-
-        # An empty set instead of list (to avoid duplicates) to store extracted event name
-        event_names = set()
-        event_name_REGEX = re.compile(r'ATP\s(.+?)\s\d{4}')
-        for row in rows:
-            event_id = row[0]
-            match = event_name_REGEX.search(event_id)
-            if match:
-                event_names.add(match.group(1))
-        print(event_names)
-        for event_name in event_names:
-            self.cursor.execute("UPDATE MensATPSingles SET EventName = ? WHERE EventID LIKE ?",
-                                (event_name, f'%ATP {event_name}%'))
-        self.conn.commit()
+        # Event name is extracted from EventID for every row in one pass.
+        self.cursor.execute("""UPDATE MensATPSingles SET EventName = event_name(EventID)
+                               WHERE event_name(EventID) IS NOT NULL""")
+        self.cursor.execute("SELECT DISTINCT EventName FROM MensATPSingles WHERE EventName IS NOT NULL")
+        print({row[0] for row in self.cursor.fetchall()})
 
     def append_court_surface(self):
-        self.cursor.execute("PRAGMA table_info(MensATPSingles)")
-        columns = self.cursor.fetchall()
-        court_surface_column_exists = any(column[1] == 'CourtSurface' for column in columns) # Returns True if any column = 'CourtSurface'.
-        if not court_surface_column_exists:
-            self.cursor.execute('''ALTER TABLE MensATPSingles
-                                        ADD COLUMN CourtSurface TEXT''')
-        self.conn.commit()
-
+        # Load the surfaces into a temp table and fill every empty CourtSurface with one UPDATE.
         df = pd.read_csv('event_courtsurfaces.csv', sep=';')
-        for _, row in df.iterrows():
-
-            event_name = row['EventName']
-            court_surface = row['CourtSurface']
-            self.cursor.execute('SELECT CourtSurface FROM MensATPSingles WHERE EventName = ?', (event_name,))
-            existing_court_surface = self.cursor.fetchone()
+        self.cursor.execute("CREATE TEMP TABLE IF NOT EXISTS EventCourtSurfaces (EventName TEXT, CourtSurface TEXT)")
+        self.cursor.execute("DELETE FROM EventCourtSurfaces")
+        self.cursor.executemany("INSERT INTO EventCourtSurfaces (EventName, CourtSurface) VALUES (?, ?)",
+                                df[['EventName', 'CourtSurface']].itertuples(index=False, name=None))
 
-            # If CourtSurface is empty or null, update it
-            if not existing_court_surface or not existing_court_surface[0]:
-                self.cursor.execute('UPDATE MensATPSingles SET CourtSurface = ? WHERE EventName = ?',
-                                    (court_surface, event_name))
-        self.conn.commit()
+        # If CourtSurface is empty or null, update it
+        self.cursor.execute("""UPDATE MensATPSingles SET CourtSurface = (
+                               SELECT surfaces.CourtSurface FROM EventCourtSurfaces AS surfaces
+                               WHERE surfaces.EventName = MensATPSingles.EventName
+                               ORDER BY surfaces.rowid LIMIT 1)
+                               WHERE (CourtSurface IS NULL OR CourtSurface = '')
+                               AND EventName IN (SELECT EventName FROM EventCourtSurfaces)""")
 
 
 '''
@@ -407,56 +763,145 @@ Input: data.db
                 Winner TEXT,
                 Loser TEXT)
 
-Output: model_df.csv, player_index.csv, court_surface_index.csv
+Output: model_df, player_index_df, court_surface_index_df
+    As .csv (default) or .feather (table_format='feather'). Feather is Arrow IPC with compact dtypes and can be
+    memory-mapped by the API on startup.
 '''
 
-
 class PrepareDataframe:
-    def __init__(self, auto_run= False):
-        self.conn = sqlite3.connect('data.db')
-        self.cursor = self.conn.cursor()
-        self.cursor.execute('SELECT * FROM MensATPSingles')
-        results = self.cursor.fetchall()
-        columns = [col[0] for col in self.cursor.description]
-        self.df = pd.DataFrame(results, columns=columns)
-        self.conn.close()
+    def __init__(self, auto_run= False, table_format= 'csv', incremental= False):
+        if table_format not in ('csv', 'feather'):
+            raise ValueError(f"Unknown table format '{table_format}'. Use 'csv' or 'feather'.")
+        self.table_format = table_format
 
         self.tables_dir = os.path.join('backend-services', 'fastapi', 'tables')
         os.makedirs(self.tables_dir, exist_ok=True) 
+        # Last MensATPSingles rowid included in the tables, so an incremental build only reads the rows after it.
+        self.build_state_path = os.path.join(self.tables_dir, 'build_state.json')
+
+        # Falls back to a full build when there are no tables from an earlier build in this format.
+        self.incremental = incremental and self.can_update()
+        # An incremental run is meant to run unattended (e.g. a daily cron job), so it never prompts before
+        # overwriting the tables, also when it falls back to a full build.
+        self.overwrite = incremental
+        self.previous_rowid = self.read_build_state()['last_rowid'] if self.incremental else 0
+        self.df = self.read_matches(self.previous_rowid)
 
         if auto_run:
-            self.prepare_dataframe()
+            if self.incremental:
+                self.update_dataframe()
+            else:
+                self.prepare_dataframe()
+
+    def read_matches(self, after_rowid: int) -> pd.DataFrame:
+        conn = sqlite3.connect('data.db')
+        cursor = conn.cursor()
+        cursor.execute('SELECT rowid, * FROM MensATPSingles WHERE rowid > ? ORDER BY rowid', (after_rowid,))
+        results = cursor.fetchall()
+        columns = [col[0] for col in cursor.description]
+        conn.close()
+
+        df = pd.DataFrame(results, columns=columns)
+        self.last_rowid = int(df['rowid'].max()) if len(df) else after_rowid
+
+        return df.drop(columns=['rowid'])
+
+    def read_build_state(self) -> dict:
+        with open(self.build_state_path) as file:
+            return json.load(file)
+
+    def write_build_state(self):
+        with open(self.build_state_path, 'w') as file:
+            json.dump({'last_rowid': self.last_rowid, 'table_format': self.table_format}, file, indent=2)
+
+    def can_update(self) -> bool:
+        if not os.path.exists(self.build_state_path):
+            print("No earlier build found. Running a full build.")
+            return False
+        if self.read_build_state().get('table_format') != self.table_format:
+            print(f"Earlier build wasn't written as {self.table_format}. Running a full build.")
+            return False
+        if not all(os.path.exists(self.table_path(table_name)) for table_name in TABLE_DTYPES):
+            print("Tables from the earlier build are missing. Running a full build.")
+            return False
+        return True
         
     def prepare_dataframe(self):
-        self.df = self.create_binary_target()
+        self.df = self.create_binary_target(self.df)
         self.df = self.create_player_index(self.df)
         self.df = self.calc_headtohead(self.df)
         self.create_court_surface_index()
         self.df = self.encode_df_court_surface(self.df)
         self.df = self.matchup_hash(self.df)
 
-        self.export_dataframe(self.df)
+        self.export_dataframe(self.df, overwrite=self.overwrite)
+        self.write_build_state()
 
-    def create_binary_target(self):
+    def update_dataframe(self):
+        # Incremental build: only the matches added since the last build are encoded. Existing players keep their
+        # indices, and the total wins and head-to-head of the existing rows are updated by the new matches' delta.
+        # Only appended matches are handled. Run a full build after changing the cleanup rules.
+        if self.df.empty:
+            print("No new matches since the last build.")
+            return
+
+        model_df = self.read_table(self.table_path('model_df'))
+        player_index_df = self.read_table(self.table_path('player_index_df'))
+        self.create_court_surface_index()
+
+        new_df = self.create_binary_target(self.df)
+        new_df, player_index_df = self.append_player_index(new_df, player_index_df)
+        player_index_df = self.add_total_wins(new_df, player_index_df)
+        model_df, new_df = self.update_headtohead(model_df, new_df, self.previous_matchup_wins(player_index_df))
+        new_df = self.encode_df_court_surface(new_df)
+        new_df = self.matchup_hash(new_df)
+
+        # Total wins are repeated on every row, so rows of players with new wins are refreshed too.
+        model_df = pd.concat([model_df, new_df], ignore_index=True)
+        model_df = self.fill_total_wins(model_df, player_index_df)
+
+        player_index_path = self.table_path('player_index_df')
+        self.write_table(player_index_df, player_index_path, TABLE_DTYPES['player_index_df'])
+        print(f"Player index exported to {player_index_path}")
+        self.export_dataframe(model_df, overwrite=True)
+        self.write_build_state()
+        print(f"Added {len(new_df)} matches.")
+
+    def create_binary_target(self, df):
         # Drop column not needed for the prediction algorithm.
         columns_drop = ['EventID', 'Player1Country', 'Player2Country', 'MatchDate', 'EventName']
-        sub_df = self.df.drop(columns=columns_drop)
+        sub_df = df.drop(columns=columns_drop)
 
-        sub_df['Target'] = 0
-        # Iterate over each row in the DataFrame & assign target 1/0 based on which player won.
+        # Assign target 1/0 based on which player won.
         # 1 = Player1 win
         # 0 = Player2 win
-        for index, row in self.df.iterrows():
-            if row['Winner'] == row['Player1']:
-                sub_df.at[index, 'Target'] = 1
-            elif row['Winner'] == row['Player2']:
-                sub_df.at[index, 'Target'] = 0
+        sub_df['Target'] = np.where(df['Winner'] == df['Player1'], 1, 0)
         sub_df.drop(columns=['Winner', 'Loser'], inplace=True)
 
         return sub_df
 
-    def create_player_index(self, df, filename= 'player_index_df.csv'):
-        file_path = os.path.join(self.tables_dir, filename)
+    def table_path(self, table_name: str) -> str:
+        return os.path.join(self.tables_dir, f"{table_name}.{self.table_format}")
+
+    def write_table(self, df, file_path: str, compact_dtypes: dict[str, str]):
+        # Written next to the old file and renamed over it, so an API that has the old feather file memory-mapped
+        # keeps reading the old data instead of a half-written file.
+        temp_path = f"{file_path}.tmp"
+        if self.table_format == 'feather':
+            # Uncompressed so the file can be memory-mapped. Feather needs a default index.
+            df.astype(compact_dtypes).reset_index(drop=True).to_feather(temp_path, compression='uncompressed')
+        else:
+            df.to_csv(temp_path, index=False)
+        os.replace(temp_path, file_path)
+
+    def read_table(self, file_path: str):
+        if self.table_format == 'feather':
+            return pd.read_feather(file_path)
+
+        return pd.read_csv(file_path)
+
+    def create_player_index(self, df, table_name= 'player_index_df'):
+        file_path = self.table_path(table_name)
         # Concatenate Player1 and Player2 into one list (contains duplicates).
         players = pd.concat([df['Player1'], df['Player2']], ignore_index=True)
 
@@ -473,7 +918,7 @@ class PrepareDataframe:
 
         # Calculate total wins for each player to store in the player index.
         player_index_df = self.calc_total_wins(df, player_index_df)
-        player_index_df.to_csv(file_path, index= False)
+        self.write_table(player_index_df, file_path, TABLE_DTYPES['player_index_df'])
         print(f"Player index exported to {file_path}")
 
         merged_df = self.merge_total_wins(df, player_index_df)
@@ -481,20 +926,48 @@ class PrepareDataframe:
         return merged_df
     
     def calc_total_wins(self, df, player_index_df):
-        player_index_df['TotalWins'] = 0
+        # Wins as Player1 (Target = 1) plus wins as Player2 (Target = 0), counted for all players at once.
+        # Player indices are small consecutive integers, so they can be used directly as bincount bins.
+        bins = int(player_index_df['Index'].max()) + 1
+        wins_as_player1 = np.bincount(df.loc[df['Target'] == 1, 'Player1'], minlength=bins)
+        wins_as_player2 = np.bincount(df.loc[df['Target'] == 0, 'Player2'], minlength=bins)
+        player_index_df['TotalWins'] = (wins_as_player1 + wins_as_player2)[player_index_df['Index']]
+
+        return player_index_df
+    
+    def append_player_index(self, df, player_index_df):
+        # Players seen before keep their index. New players are numbered after the highest existing index,
+        # in the same first-seen order as create_player_index.
+        name_to_number = dict(zip(player_index_df['Player'], player_index_df['Index'].tolist()))
+        players = pd.concat([df['Player1'], df['Player2']], ignore_index=True).unique()
+        new_names = [name for name in players if name not in name_to_number]
+        first_index = int(player_index_df['Index'].max()) + 1 if len(player_index_df) else 1
+        new_players = pd.DataFrame({'Player': new_names, 'Index': range(first_index, first_index + len(new_names)),
+                                    'TotalWins': 0})
+        name_to_number.update(zip(new_players['Player'], new_players['Index'].tolist()))
+
+        df['Player1'] = df['Player1'].map(name_to_number)
+        df['Player2'] = df['Player2'].map(name_to_number)
+        player_index_df = pd.concat([player_index_df, new_players], ignore_index=True)
 
-        for index, row in player_index_df.iterrows():
-            player_index = row['Index']
-            wins_as_player1 = df.loc[(df['Player1'] == player_index) & (df['Target'] == 1), 'Target'].count()
-            player_index_df.loc[index, 'TotalWins'] += wins_as_player1
+        return df, player_index_df
 
-        for index, row in player_index_df.iterrows():
-            player_index = row['Index']
-            wins_as_player2 = df.loc[(df['Player2'] == player_index) & (df['Target'] == 0), 'Target'].count()
-            player_index_df.loc[index, 'TotalWins'] += wins_as_player2
+    def add_total_wins(self, df, player_index_df):
+        # Same counting as calc_total_wins, over the new matches only, added to the stored totals.
+        new_wins = self.calc_total_wins(df, player_index_df[['Player', 'Index']].copy())['TotalWins']
+        player_index_df['TotalWins'] = player_index_df['TotalWins'].to_numpy() + new_wins.to_numpy()
 
         return player_index_df
-    
+
+    def fill_total_wins(self, df, player_index_df):
+        # Looks up both players' current totals for every row, by player index.
+        total_wins = np.zeros(int(player_index_df['Index'].max()) + 1, dtype=np.int64)
+        total_wins[player_index_df['Index'].to_numpy()] = player_index_df['TotalWins'].to_numpy()
+        df['TotalWins_Player1'] = total_wins[df['Player1'].to_numpy()]
+        df['TotalWins_Player2'] = total_wins[df['Player2'].to_numpy()]
+
+        return df
+
     def merge_total_wins(self, df, player_index_df):
         merged_df = pd.merge(df, player_index_df, left_on='Player1', right_on='Index', how='left')
         merged_df.rename(columns={'TotalWins': 'TotalWins_Player1'}, inplace=True)
@@ -508,31 +981,74 @@ class PrepareDataframe:
     
     def calc_headtohead(self, df):
         # Variable to measure total wins/losses in matchup between Player1 and Player2.
-        df['HeadToHead'] = 0
-        for index, row in df.iterrows():
-            # Calculate instances of 'Player1' vs 'Player2' where 'Target' = 1.
-            player1_wins = (df[(df['Player1'] == row['Player1']) & (df['Player2'] == row['Player2'])][
-                                'Target'] == 1).sum()
-            # Same as above but in reverse. (I know it's a bit confusing that df['Player1'] is row[PLayer2]).
-            # I have another way of doing this further down which might be easier to follow.
-            df.at[index, 'HeadToHead'] = player1_wins - ((df[(df['Player1'] == row['Player2']) & (
-                    df['Player2'] == row['Player1'])]['Target'] == 1).sum())  # Calculate win-loss difference
+        # Count wins where Target = 1 once per (Player1, Player2) pair, then look the counts up for each row
+        # in both directions. Same values as comparing every row against the whole DataFrame, in linear time.
+        player1_wins = df[df['Target'] == 1].groupby(['Player1', 'Player2']).size()
+        matchups = pd.MultiIndex.from_arrays([df['Player1'], df['Player2']])
+        reverse_matchups = pd.MultiIndex.from_arrays([df['Player2'], df['Player1']])
+        # Calculate win-loss difference.
+        df['HeadToHead'] = (player1_wins.reindex(matchups, fill_value=0).to_numpy()
+                            - player1_wins.reindex(reverse_matchups, fill_value=0).to_numpy())
 
         return df
 
-    def create_court_surface_index(self, filename= 'court_surface_index_df.csv'):
-        file_path = os.path.join(self.tables_dir, filename)
+    def previous_matchup_wins(self, player_index_df):
+        # Player1 wins per ordered pair in the matches of earlier builds, for the pairs that have new matches.
+        # model_df can't give these, it doesn't keep the matches dropped for a missing court surface.
+        pairs = pd.concat([self.df[['Player1', 'Player2']],
+                           self.df[['Player2', 'Player1']].set_axis(['Player1', 'Player2'], axis=1)]).drop_duplicates()
+        conn = sqlite3.connect('data.db')
+        conn.execute("CREATE TEMP TABLE NewMatchups (Player1 TEXT, Player2 TEXT)")
+        conn.executemany("INSERT INTO NewMatchups (Player1, Player2) VALUES (?, ?)",
+                         pairs.itertuples(index=False, name=None))
+        # Joined through the Player1 index, so only the matches of these pairs are read.
+        rows = conn.execute("""SELECT m.Player1, m.Player2, COUNT(*) FROM MensATPSingles AS m
+                               JOIN NewMatchups AS n ON m.Player1 = n.Player1 AND m.Player2 = n.Player2
+                               WHERE m.rowid <= ? AND m.Winner = m.Player1
+                               GROUP BY m.Player1, m.Player2""", (self.previous_rowid,)).fetchall()
+        conn.close()
+
+        name_to_number = dict(zip(player_index_df['Player'], player_index_df['Index'].tolist()))
+        matchups = pd.MultiIndex.from_arrays([[name_to_number[row[0]] for row in rows],
+                                              [name_to_number[row[1]] for row in rows]], names=['Player1', 'Player2'])
+        return pd.Series([row[2] for row in rows], index=matchups, dtype=np.int64)
+
+    def update_headtohead(self, model_df, new_df, previous_wins):
+        # A pair's head-to-head only changes by the new matches between the two players:
+        # HeadToHead(a, b) += new wins of a over b - new wins of b over a.
+        new_wins = new_df[new_df['Target'] == 1].groupby(['Player1', 'Player2']).size()
+        delta = new_wins.sub(new_wins.swaplevel().rename_axis(['Player1', 'Player2']), fill_value=0).astype(np.int64)
+
+        # Existing rows are only touched where both players have new matches.
+        players = np.unique(np.concatenate([new_df['Player1'].to_numpy(), new_df['Player2'].to_numpy()]))
+        rows = (model_df['Player1'].isin(players) & model_df['Player2'].isin(players)).to_numpy()
+        matchups = pd.MultiIndex.from_arrays([model_df.loc[rows, 'Player1'], model_df.loc[rows, 'Player2']])
+        updated = model_df.loc[rows, 'HeadToHead'].to_numpy() + delta.reindex(matchups, fill_value=0).to_numpy()
+        model_df.loc[rows, 'HeadToHead'] = updated.astype(model_df['HeadToHead'].dtype)
+
+        # New rows get the full count over the earlier and new matches, same as calc_headtohead.
+        player1_wins = previous_wins.add(new_wins, fill_value=0).astype(np.int64)
+        new_matchups = pd.MultiIndex.from_arrays([new_df['Player1'], new_df['Player2']])
+        reverse_matchups = pd.MultiIndex.from_arrays([new_df['Player2'], new_df['Player1']])
+        new_df['HeadToHead'] = (player1_wins.reindex(new_matchups, fill_value=0).to_numpy()
+                                - player1_wins.reindex(reverse_matchups, fill_value=0).to_numpy())
+
+        return model_df, new_df
+
+    def create_court_surface_index(self, table_name= 'court_surface_index_df'):
+        file_path = self.table_path(table_name)
         if os.path.exists(file_path):
-            return f"Court surface index already exists: {filename}"
+            self.court_surface_index_df = self.read_table(file_path)
+            return f"Court surface index already exists: {file_path}"
         
-        court_surface_index_df = pd.DataFrame({'CourtSurface': ['Hard Court', 'Clay', 'Grass'], 'Index': [1, 2, 3]})
-        court_surface_index_df.to_csv(file_path, index=False)
+        self.court_surface_index_df = pd.DataFrame({'CourtSurface': ['Hard Court', 'Clay', 'Grass'], 'Index': [1, 2, 3]})
+        self.write_table(self.court_surface_index_df, file_path, TABLE_DTYPES['court_surface_index_df'])
         print(f"Court Surface data frame exported to {file_path}")
 
     def encode_df_court_surface(self, df):
         # Replace CourtSurface entries from dataset with their indexed values from above.
         # OBS this function also removes all entries where CurtSurface is missing.
-        index = pd.read_csv('court_surface_index_df.csv')
+        index = self.court_surface_index_df
         encoded_df = pd.merge(df, index, how='left', on='CourtSurface')
         encoded_df.drop(columns=['CourtSurface'], inplace=True)
         encoded_df.rename(columns={'Index': 'CourtSurface'}, inplace=True)
@@ -544,48 +1060,37 @@ class PrepareDataframe:
         # Hash Player1(index) and Player2(index). Winner first.
         # Reason for this is to even out the bias towards either Player1 or Player2 in the dataset->
         # where a player appears more in either column.
-        df['WinnerLoserHash'] = 0
-        for index, row in df.iterrows():
-            hasher = hashlib.sha256()
-            player1 = str(row['Player1'])
-            player2 = str(row['Player2'])
-            target = row['Target']
-            if target == 1:
-                player1_winner = [player1, player2]
-                combined_players = "#".join(player1_winner)
-                hasher.update(combined_players.encode('utf-8'))
-                hash = hasher.hexdigest()
-                # Hasher returns a hex value that's too long for the prediction model to handle, so it must be shortened.
-                short_hash = hash[:12]
-                # The prediction model also can't handle hex values, so it has to be converted to an integer.
-                normalized_hash = int(short_hash, 16)
-                df.at[index, 'WinnerLoserHash'] = normalized_hash
-
-            elif target == 0:
-                player2_winner = [player2, player1]
-                combined_players = "#".join(player2_winner)
-                hasher.update(combined_players.encode('utf-8'))
-                hash = hasher.hexdigest()
-                short_hash = hash[:12]
-                normalized_hash = int(short_hash, 16)
-                df.at[index, 'WinnerLoserHash'] = normalized_hash
+        winners = np.where(df['Target'] == 1, df['Player1'], df['Player2'])
+        losers = np.where(df['Target'] == 1, df['Player2'], df['Player1'])
+        matchups = pd.Series(winners).astype(str) + "#" + pd.Series(losers).astype(str)
+        # Each pairing is only hashed once and the result is spread back over all its matches.
+        codes, unique_matchups = pd.factorize(matchups)
+        unique_hashes = np.array([self.normalized_hash(matchup) for matchup in unique_matchups], dtype=np.int64)
+        df['WinnerLoserHash'] = unique_hashes[codes]
 
         return df
 
-    def export_dataframe(self, df, filename='model_df.csv'):
-        file_path = os.path.join(self.tables_dir, filename)
-        if os.path.exists(file_path):
+    def normalized_hash(self, combined_players: str) -> int:
+        hash = hashlib.sha256(combined_players.encode('utf-8')).hexdigest()
+        # Hasher returns a hex value that's too long for the prediction model to handle, so it must be shortened.
+        short_hash = hash[:12]
+        # The prediction model also can't handle hex values, so it has to be converted to an integer.
+        return int(short_hash, 16)
+
+    def export_dataframe(self, df, table_name='model_df', overwrite= False):
+        file_path = self.table_path(table_name)
+        if os.path.exists(file_path) and not overwrite:
             while True:
-                user_response = input(f"The file {filename} already exists. Do you want to overwrite it? (y/n): ").lower().strip()
+                user_response = input(f"The file {file_path} already exists. Do you want to overwrite it? (y/n): ").lower().strip()
                 if user_response in ['y', 'yes']:
-                    df.to_csv(file_path, index=False)
+                    self.write_table(df, file_path, TABLE_DTYPES['model_df'])
                     print(f"Dataframe exported to {file_path}")
                     break
                 elif user_response in ['n', 'no']:
-                    new_filename = input("Enter new filename: ").strip() + '.csv'
-                    if new_filename:
-                        new_file_path = os.path.join(self.tables_dir, new_filename)
-                        df.to_csv(new_file_path, index=False)
+                    new_table_name = input("Enter new filename: ").strip()
+                    if new_table_name:
+                        new_file_path = self.table_path(new_table_name)
+                        self.write_table(df, new_file_path, TABLE_DTYPES['model_df'])
                         print(f"Dataframe exported to {new_file_path}")
                         break
                     else:
@@ -593,14 +1098,14 @@ class PrepareDataframe:
                 else:
                     print("Invalid input. Please respond with 'y' or 'n'.")
         else:
-            df.to_csv(file_path, index=False)
+            self.write_table(df, file_path, TABLE_DTYPES['model_df'])
             print(f"Dataframe exported to {file_path}")
 
 
-def run(auto_run= True):
-    TennisMatchScraper(auto_run)
+def run(auto_run= True, workers= 1, table_format= 'csv', incremental= False):
+    TennisMatchScraper(auto_run, workers)
     DataCleanup(auto_run)
-    PrepareDataframe(auto_run)
+    PrepareDataframe(auto_run, table_format, incremental)
 
 if __name__ == "__main__":
     run()
\ No newline at end of file
@@ -0,0 +1,80 @@
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from scraper import PrepareDataframe
+from benchmarks.synthetic_data import write_database
+from benchmarks.bench_encoding import (encode_players, legacy_calc_headtohead, legacy_calc_total_wins,
+                                       legacy_create_binary_target, legacy_matchup_hash)
+
+'''
+Checks the vectorized PrepareDataframe encoding stages against the row-by-row versions they replaced
+(kept in benchmarks/bench_encoding.py), on a small synthetic dataset. Also checks that an incremental
+build never stops at a prompt.
+
+Run from the repository root:
+    python -m pytest tests
+'''
+
+
+@pytest.fixture
+def prepare(tmp_path, monkeypatch):
+    # PrepareDataframe reads data.db and writes its tables relative to the working directory.
+    monkeypatch.chdir(tmp_path)
+    # Few players, so most matchups are played several times and in both orders.
+    write_database('data.db', matches=400, players=25, seed=7)
+    return PrepareDataframe()
+
+
+@pytest.fixture
+def encoded(prepare):
+    df, player_index_df = encode_players(prepare.create_binary_target(prepare.df))
+    return df, player_index_df
+
+
+def test_create_binary_target_matches_row_loop(prepare):
+    pd.testing.assert_frame_equal(prepare.create_binary_target(prepare.df), legacy_create_binary_target(prepare.df))
+
+
+def test_calc_total_wins_matches_row_loop(prepare, encoded):
+    df, player_index_df = encoded
+    pd.testing.assert_frame_equal(prepare.calc_total_wins(df, player_index_df.copy()),
+                                  legacy_calc_total_wins(df, player_index_df.copy()))
+
+
+def test_calc_headtohead_matches_row_loop(prepare, encoded):
+    df, _ = encoded
+    headtohead = prepare.calc_headtohead(df.copy())
+    pd.testing.assert_frame_equal(headtohead, legacy_calc_headtohead(df.copy()))
+    # Both orders of a matchup are in the data, so the test covers negative values too.
+    assert (headtohead['HeadToHead'] < 0).any() and (headtohead['HeadToHead'] > 0).any()
+
+
+def test_calc_headtohead_after_row_filtering(prepare, encoded):
+    # encode_df_court_surface drops rows, so calc_headtohead mustn't rely on a default index.
+    df, _ = encoded
+    df = df.iloc[::3].copy()
+    pd.testing.assert_frame_equal(prepare.calc_headtohead(df.copy()), legacy_calc_headtohead(df.copy()))
+
+
+def test_matchup_hash_matches_row_loop(prepare, encoded):
+    df, _ = encoded
+    pd.testing.assert_frame_equal(prepare.matchup_hash(df.copy()), legacy_matchup_hash(df.copy()))
+
+
+def test_incremental_fallback_does_not_prompt(prepare, monkeypatch):
+    # Tables from an earlier build without build_state.json (e.g. written before incremental builds existed).
+    # The incremental run falls back to a full build and must overwrite them without asking, as under cron.
+    PrepareDataframe(auto_run=True)
+    os.remove(os.path.join(prepare.tables_dir, 'build_state.json'))
+
+    def no_input(prompt):
+        raise EOFError("stdin is closed")
+    monkeypatch.setattr('builtins.input', no_input)
+    rebuilt = PrepareDataframe(auto_run=True, incremental=True)
+
+    assert not rebuilt.incremental
+    assert os.path.exists(os.path.join(prepare.tables_dir, 'build_state.json'))